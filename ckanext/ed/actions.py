@@ -1,26 +1,35 @@
 from logging import getLogger
+import datetime
+import functools
+import hashlib
+import json
+import mimetypes
 import os
-import requests
+import time
 import uuid
 import zipfile
 
-from ckan.controllers.admin import get_sysadmins
+from ckan import authz, model
+from ckan.common import config, request
+from ckan.lib import uploader
+from ckan.lib.activity_streams import activity_list_to_html
+from ckan.lib.dictization import model_dictize
+from ckan.lib.helpers import literal
+from ckan.lib.i18n import get_lang
 from ckan.lib.mailer import MailerException
+from ckan.lib.redis import connect_to_redis
 from ckan.logic.action.create import package_create as core_package_create
 from ckan.logic.action.update import package_update as core_package_update
-from ckan.logic.action.get import activity_detail_list as core_activity_detail_list
-from ckan.logic.action.get import dashboard_activity_list as core_dashboard_activity_list
-from ckan.logic.action.get import group_activity_list as core_group_activity_list
-from ckan.logic.action.get import package_activity_list as core_package_activity_list
 from ckan.logic.action.get import package_show as core_package_show
-from ckan.logic.action.get import recently_changed_packages_activity_list as core_recently_changed_packages_activity_list
 from ckan.plugins import toolkit
+from redis.exceptions import RedisError
+import sqlalchemy
 
-from ckanext.ed import helpers
+from ckanext.ed import archive, helpers
 from ckanext.ed.mailer import mail_package_publish_request_to_admins
 
 
-SUPPORTED_RESOURCE_MIMETYPES = [
+SUPPORTED_RESOURCE_MIMETYPES = frozenset([
     'application/vnd.openxmlformats-officedocument.presentationml.presentation',
     'application/x-msdownload',
     'application/msword',
@@ -78,7 +87,50 @@ SUPPORTED_RESOURCE_MIMETYPES = [
     'image/png',
     'application/rss+xml',
     'application/geo+json'
-]
+])
+
+# Supported formats that are not compressed already. Only these are
+# deflated in zip archives, anything else is stored as it is
+COMPRESSIBLE_RESOURCE_MIMETYPES = frozenset([
+    'application/msword',
+    'application/vnd.google-earth.kml+xml',
+    'application/vnd.ms-excel',
+    'application/msexcel',
+    'application/x-msexcel',
+    'application/x-ms-excel',
+    'application/x-excel',
+    'application/x-dos_ms_excel',
+    'application/xls',
+    'application/x-xls',
+    'application/x-javascript',
+    'application/x-msaccess',
+    'text/tab-separated-values',
+    'text/x-perl',
+    'application/owl+xml',
+    'application/x-n3',
+    'application/x-qgis',
+    'application/json',
+    'image/x-ms-bmp',
+    'text/plain',
+    'application/xml',
+    'application/xslt+xml',
+    'image/svg+xml',
+    'application/vnd.ms-powerpoint',
+    'application/sparql-results+xml',
+    'application/rdf+xml',
+    'text/csv',
+    'application/atom+xml',
+    'application/x-tar',
+    'application/rss+xml',
+    'application/geo+json'
+])
+
+# Datasets whose archive is built once the session is committed
+PRECOMPUTE_SESSION_KEY = 'ckanext.ed.precompute'
+
+# Rendered streams show relative times ("5 minutes ago"), so they are only
+# reused for a few minutes
+ACTIVITY_STREAM_CACHE_TTL = 5 * 60
 
 log = getLogger(__name__)
 
@@ -89,65 +141,714 @@ def prepare_zip_resources(context, data_dict):
 
     :param resources: a list of ids of the resources
     :type resources: list
+    :param background: build the archive in a background job instead
+        (optional, default: False)
+    :type background: boolean
+    :param manifest: add a manifest.json with the size, SHA-256, source URL
+        and resource id of every entry (optional, default: False)
+    :type manifest: boolean
 
-    :return: a dictionary containing the zip_id of the created archive
+    :return: a dictionary containing the zip_id and SHA-256 (`checksum`) of
+        the created archive and the resources left out of it with the reason
+        (`skipped`) or, in background mode, the job_id to pass to
+        `ed_zip_status` unless the archive is already cached
     :rtype: dict
     """
-    file_name = uuid.uuid4().hex + '.{ext}'.format(ext='zip')
-    file_path = helpers.get_storage_path_for('temp-ed') + '/' + file_name
+    resource_ids = data_dict.get('resources')
+    manifest = toolkit.asbool(data_dict.get('manifest', False))
+    job_id = uuid.uuid4().hex
+
+    # Identical selections of unchanged resources are served from the cache
+    resources = _show_resources(resource_ids)
+    cached_file_name = archive.get_cached_archive(
+        archive.get_cache_key(resources, manifest))
+    if cached_file_name is not None:
+        return {
+            'zip_id': _get_zip_id(
+                cached_file_name, resources[0]['package_id']),
+            'checksum': archive.get_archive_checksum(cached_file_name),
+            'skipped': [_get_skipped(entry)
+                        for entry in _get_zip_entries(resources)
+                        if entry['skipped'] is not None]
+        }
+
+    # Requests over the limits are refused before anything is downloaded
+    size = _check_zip_size(_get_zip_entries(resources))
+
+    # Abandoned archives are swept before another one is built, and the new
+    # one has to fit in the storage too. A quota of 0 or less means
+    # unlimited
+    storage_size = archive.cleanup_storage()
+    quota = archive.get_storage_quota()
+    if quota > 0 and (storage_size >= quota or storage_size + size > quota):
+        raise toolkit.ValidationError({'resources': [toolkit._(
+            'The storage for zip archives is full. '
+            'Please try again later or select fewer resources.')]})
+
+    background = toolkit.asbool(data_dict.get('background', False))
+    _admit_zip_job(job_id, {
+        'state': 'queued' if background else 'running',
+        'resources_total': len(resource_ids),
+        'resources_done': 0,
+        'bytes_written': 0,
+        'zip_id': None,
+        'skipped': []
+    }, context.get('user'))
+
+    if background:
+        toolkit.enqueue_job(
+            prepare_zip_resources_job,
+            [job_id, resource_ids, context.get('user'), manifest],
+            title='Zip archive {id}'.format(id=job_id))
+        return {'job_id': job_id}
+
+    try:
+        return _build_zip_archive(job_id, resources, manifest=manifest)
+    finally:
+        archive.remove_status(job_id)
+
+
+@toolkit.side_effect_free
+def zip_status(context, data_dict):
+    """Returns the progress of a zip archive built in the background.
+
+    :param id: the job_id returned by `ed_prepare_zip_resources`
+    :type id: string
+
+    :return: a dictionary containing the state (one of queued, running,
+        finished or failed), resources_total, resources_done, bytes_written
+        and, once finished, the zip_id of the archive and the skipped
+        resources
+    :rtype: dict
+    """
+    job_id = toolkit.get_or_bust(data_dict, 'id')
+    status = archive.read_status(job_id)
+    if status is None:
+        raise toolkit.ObjectNotFound(toolkit._('Zip archive not found'))
+    status.pop('user', None)
+    return status
+
+
+def prepare_zip_resources_job(job_id, resource_ids, user=None,
+                              manifest=False):
+    '''Background job for `prepare_zip_resources`. Progress is reported
+    through the job status read by `zip_status`.
+    '''
+    status = archive.read_status(job_id) or {}
+    status.update(state='running')
+    archive.write_status(job_id, status)
+
+    def progress(resources_done, bytes_written):
+        status.update(
+            resources_done=resources_done, bytes_written=bytes_written)
+        archive.write_status(job_id, status)
+
+    try:
+        result = _build_zip_archive(
+            job_id, _show_resources(resource_ids, user), user=user,
+            progress=progress, manifest=manifest)
+    except Exception:
+        status.update(state='failed')
+        archive.write_status(job_id, status)
+        raise
+
+    status.update(
+        state='finished', zip_id=result['zip_id'],
+        checksum=result['checksum'], skipped=result['skipped'])
+    archive.write_status(job_id, status)
+
+
+def enqueue_dataset_zip(package_id):
+    '''Schedules building the archive of all the resources of a dataset when
+    `ckanext.ed.zip.precompute` is enabled. The job is queued once the
+    changes of the dataset are committed, as it would read the previous
+    version of the dataset otherwise.
+    '''
+    if not archive.is_precompute_enabled():
+        return
+    model.Session.info.setdefault(PRECOMPUTE_SESSION_KEY, set()).add(
+        package_id)
+
+
+def listen_for_commits():
+    '''Queues the archives scheduled by `enqueue_dataset_zip`, and drops the
+    homepage datasets if `helpers.expire_homepage_datasets_on_commit` was
+    called, when the session is committed. Both are forgotten when it is
+    rolled back.
+    '''
+    for identifier, fn in (('after_commit', _after_commit),
+                           ('after_rollback', _after_rollback)):
+        if not sqlalchemy.event.contains(model.Session, identifier, fn):
+            sqlalchemy.event.listen(model.Session, identifier, fn)
+
+
+def _after_commit(session):
+    # The changes are saved already, so cache errors do not fail them
+    package_ids = session.info.pop(PRECOMPUTE_SESSION_KEY, ())
+    expire_homepage = session.info.pop(helpers.HOMEPAGE_SESSION_KEY, False)
+    if expire_homepage:
+        try:
+            helpers.expire_homepage_datasets()
+        except RedisError as e:
+            log.warning('Homepage datasets cache unavailable: %s', e)
+    for package_id in package_ids:
+        try:
+            toolkit.enqueue_job(
+                prepare_dataset_zip_job, [package_id],
+                title='Zip archive of dataset {id}'.format(id=package_id))
+        except RedisError as e:
+            log.warning('Could not queue the zip archive of dataset %s: %s',
+                        package_id, e)
+
+
+def _after_rollback(session):
+    session.info.pop(PRECOMPUTE_SESSION_KEY, None)
+    session.info.pop(helpers.HOMEPAGE_SESSION_KEY, None)
+
+
+def prepare_dataset_zip_job(package_id):
+    '''Background job building the archive of all the resources of a dataset
+    in advance, so that downloading all of them is served from the archive
+    cache. Nothing is built if the cache already holds an archive of the
+    current versions of the resources, or if too many archives are already
+    being built.
+    '''
+    user = toolkit.get_action('get_site_user')({'ignore_auth': True}, {})
+    try:
+        package = toolkit.get_action('package_show')(
+            _get_context(user['name']), {'id': package_id})
+    except toolkit.ObjectNotFound:
+        return
+
+    # Same selection as "Mark all" on the dataset page, which does not list
+    # the documentation
+    resources = [resource for resource in package.get('resources') or []
+                 if resource.get('resource_type') != 'doc']
+    if package.get('state') != 'active' or not resources:
+        return
+    if archive.get_cached_archive(archive.get_cache_key(resources)):
+        return
+
+    job_id = uuid.uuid4().hex
+    status = {
+        'state': 'running',
+        'resources_total': len(resources),
+        'resources_done': 0,
+        'bytes_written': 0,
+        'zip_id': None,
+        'skipped': []
+    }
+    limit = archive.admit_job(job_id, status, user=user['name'])
+    if limit is not None:
+        log.info('Zip archive of dataset %s not built in advance: %s reached',
+                 package_id, limit)
+        return
+
+    def progress(resources_done, bytes_written):
+        status.update(
+            resources_done=resources_done, bytes_written=bytes_written)
+        archive.write_status(job_id, dict(status, user=user['name']))
+
+    try:
+        _build_zip_archive(
+            job_id, resources, user=user['name'], progress=progress)
+    finally:
+        archive.remove_status(job_id)
+
+
+def _build_zip_archive(job_id, resources, user=None, progress=None,
+                       manifest=False):
+    '''Downloads the resources and writes them to the `job_id` archive.
+    Complete archives are moved to the archive cache.
+
+    :param resources: the resources to archive
+    :type resources: list
+    :param progress: called with the number of processed resources and the
+        bytes written so far after every resource (optional)
+    :type progress: callable
+    :param manifest: add a manifest.json describing the entries
+    :type manifest: boolean
+
+    :returns: a dictionary containing the zip_id and checksum of the created
+        archive and the skipped resources
+    :rtype: dict
+    '''
+    file_name = job_id + '.{ext}'.format(ext='zip')
+    storage_path = helpers.get_storage_path_for('temp-ed')
+    file_path = storage_path + '/' + file_name
+    chunk_size = archive.get_chunk_size()
+    max_size = archive.get_max_size()
     resourceArchived = False
-    package_id = None
+    skipped = []
+    manifest_entries = []
 
     try:
-        resource_ids = data_dict.get('resources')
-        with zipfile.ZipFile(file_path, 'w') as zip:
-            for resource_id in resource_ids:
-                data_dict = {'id': resource_id}
-                resource = toolkit.get_action('resource_show')({}, data_dict)
-
-                url = resource.get('url')
-                if resource['url_type'] == 'upload':
-                    name = url.split('/')[-1]
-                else:
-                    name = resource['name']
-                    if os.path.splitext(name)[-1] == '':
-                        _format = resource['format']
-                        if _format:
-                            name += '.{ext}'.format(ext=_format.lower())
-
-                if package_id is None:
-                    package_id = resource['package_id']
-
-                headers = {'Authorization': get_sysadmins()[0].apikey}
-                try:
-                    r = requests.get(url, headers=headers)
-                except Exception:
-                    continue
-
-                content_type = r.headers['Content-Type'].split(';')[0]
-
-                if content_type in SUPPORTED_RESOURCE_MIMETYPES:
-                    resourceArchived = True
-                    zip.writestr(name, r.content)
+        entries = _get_zip_entries(resources)
+        session = archive.get_http_session()
+        fetch = functools.partial(
+            _fetch_resource, session, chunk_size=chunk_size,
+            spool_dir=storage_path,
+            compress_level=archive.get_compress_level(), checksum=manifest)
+        try:
+            with open(file_path, 'wb') as f, archive.ZipStreamWriter(f) as zip:
+                # Resources are downloaded concurrently but written in the
+                # order they were requested in
+                fetched_resources = archive.imap_ordered(
+                    fetch, entries, archive.get_fetch_workers())
+                for done, fetched in enumerate(fetched_resources, 1):
+                    if fetched['skipped'] is None:
+                        try:
+                            resourceArchived = True
+                            if fetched['deflated'] is not None:
+                                crc, compress_size = fetched['deflated']
+                                zinfo = zip.write_compressed(
+                                    fetched['name'], fetched['chunks'], crc,
+                                    fetched['size'], compress_size)
+                            else:
+                                zinfo = zip.write_iter(
+                                    fetched['name'], fetched['chunks'],
+                                    size=fetched['size'])
+                        finally:
+                            fetched['close']()
+                        if manifest:
+                            manifest_entries.append({
+                                'name': fetched['name'],
+                                'resource_id': fetched['id'],
+                                'url': fetched['url'],
+                                'size': zinfo.file_size,
+                                'sha256': fetched['sha256'].hexdigest()
+                            })
+                    else:
+                        skipped.append(_get_skipped(fetched))
+                    # Sizes that were unknown up front are checked as well
+                    if max_size and zip.bytes_written > max_size:
+                        raise toolkit.ValidationError({'resources': [
+                            toolkit._('The zip archive is too big')]})
+                    if progress is not None:
+                        progress(done, zip.bytes_written)
+                if manifest and resourceArchived:
+                    zip.write_iter('manifest.json', [json.dumps(
+                        {'resources': manifest_entries}, indent=2)])
+        finally:
+            session.close()
     except Exception, ex:
         log.error('An error occured while preparing zip archive. Error: %s' % ex)
+        if os.path.exists(file_path):
+            os.remove(file_path)
         raise
 
+    if not resourceArchived:
+        os.remove(file_path)
+        return {'zip_id': None, 'checksum': None, 'skipped': skipped}
+
+    # The checksum becomes part of the file name, for the download ETag
+    checksum = zip.checksum
+    file_name = archive.get_archive_name(job_id, checksum)
+    os.rename(file_path, os.path.join(storage_path, file_name))
+    file_path = os.path.join(storage_path, file_name)
+
+    # Archives missing resources because of network errors are not reused
+    if not any(s['reason'] == 'fetch_failed' for s in skipped):
+        file_name = archive.store_in_cache(
+            file_path, archive.get_cache_key(resources, manifest))
+
+    return {
+        'zip_id': _get_zip_id(file_name, resources[0]['package_id'], user),
+        'checksum': checksum,
+        'skipped': skipped
+    }
+
+
+def _admit_zip_job(job_id, status, user):
+    '''Stores the status of a new zip job, or raises a ValidationError if
+    too many archives are already being built'''
+    limit = archive.admit_job(job_id, status, user=_get_requester(user))
+    if limit == 'max_jobs':
+        raise toolkit.ValidationError({'resources': [toolkit._(
+            'Too many zip archives are being prepared at the moment. '
+            'Please try again in a few minutes.')]})
+    elif limit == 'max_jobs_per_user':
+        raise toolkit.ValidationError({'resources': [toolkit._(
+            'You are already preparing other zip archives. '
+            'Please wait for them to finish.')]})
+
+
+def _get_requester(user):
+    '''Returns who `ckanext.ed.zip.max_jobs_per_user` counts the archives
+    of: the user, or the address anonymous requests come from. The address
+    is the last one of X-Forwarded-For, which the reverse proxy sets, if
+    any.
+    '''
+    if user:
+        return user
+    try:
+        environ = request.environ
+    except (TypeError, RuntimeError):
+        # Outside of a request
+        return None
+    forwarded_for = environ.get('HTTP_X_FORWARDED_FOR')
+    if forwarded_for:
+        address = forwarded_for.split(',')[-1].strip()
+    else:
+        address = environ.get('REMOTE_ADDR')
+    return 'address:{0}'.format(address) if address else None
+
+
+def _check_zip_size(entries):
+    '''Raises a ValidationError if the estimated size of the archive of the
+    entries is over `ckanext.ed.zip.max_size`
+
+    :returns: the estimated size in bytes
+    :rtype: integer
+    '''
+    # Only sizes known without a request are counted, the others are
+    # checked while the archive is written
+    size = sum(_estimate_size(entry) for entry in entries)
+    max_size = archive.get_max_size()
+    if max_size and size > max_size:
+        raise toolkit.ValidationError({'resources': [toolkit._(
+            'The selected resources are too big to be downloaded as a zip '
+            'archive ({size} MB, the limit is {max_size} MB). Please select '
+            'fewer resources.').format(
+                size=size // 1024 ** 2, max_size=max_size // 1024 ** 2)]})
+    return size
+
+
+def _estimate_size(entry):
+    '''Returns the size of a resource from the local file or its `size`
+    metadata. 0 if it is unknown or the resource is skipped.
+    '''
+    if entry['skipped'] is not None:
+        return 0
+    if entry.get('path'):
+        try:
+            return os.path.getsize(entry['path'])
+        except OSError:
+            return 0
+    return entry['size'] or 0
+
+
+def _get_skipped(entry):
+    '''Returns why a resource was left out of an archive'''
+    return {'id': entry['id'], 'name': entry['name'],
+            'reason': entry['skipped']}
+
+
+def stream_zip_resources(resources, user=None):
+    '''Returns a zip archive of the resources as an iterator of byte strings
+    that downloads and writes the resources one after the other while it is
+    iterated. Nothing is stored on disk.
+
+    Streamed archives count against the same `ckanext.ed.zip.max_jobs` and
+    `ckanext.ed.zip.max_jobs_per_user` limits as the prepared ones.
+
+    :param resources: the resources to archive
+    :type resources: list
+    :param user: name of the user the archive is streamed to
+    :type user: string
+
+    :returns: WSGI application iterator of byte strings, to be closed once
+        the response is sent
+    :rtype: iterable
+    '''
+    # Resolved before the response starts, while the request has a DB session
+    entries = _get_zip_entries(resources)
+    _check_zip_size(entries)
+    chunk_size = archive.get_chunk_size()
+    compress_level = archive.get_compress_level()
+    max_size = archive.get_max_size()
+
+    job_id = uuid.uuid4().hex
+    _admit_zip_job(job_id, {
+        'state': 'running',
+        'resources_total': len(resources),
+        'resources_done': 0,
+        'bytes_written': 0,
+        'zip_id': None,
+        'skipped': []
+    }, user)
+
+    def iter_opened(session):
+        for entry in entries:
+            opened = _open_resource(session, entry, chunk_size)
+            if opened['skipped'] is not None:
+                continue
+            try:
+                yield (opened['name'], opened['chunks'], opened['size'],
+                       _get_compress_type(
+                           opened['content_type'], compress_level))
+            finally:
+                opened['close']()
+
+    def iter_stream():
+        session = archive.get_http_session()
+        bytes_written = 0
+        try:
+            for data in archive.iter_zip_stream(
+                    iter_opened(session), compress_level=compress_level):
+                bytes_written += len(data)
+                # Sizes that were unknown up front are checked as well, the
+                # download is cut off as the response has already started
+                if max_size and bytes_written > max_size:
+                    raise toolkit.ValidationError({'resources': [
+                        toolkit._('The zip archive is too big')]})
+                yield data
+        except Exception, ex:
+            log.error('An error occured while streaming zip archive. Error: %s' % ex)
+            raise
+        finally:
+            session.close()
+
+    # The admission is released when the server closes the response, which
+    # also happens when the body is never read
+    return archive.ClosingIter(
+        iter_stream(), functools.partial(archive.remove_status, job_id))
+
+
+def _get_zip_entries(resources):
+    '''Returns the archive entry name and where to read it from for every
+    resource.
+
+    Resources whose mimetype is known to be unsupported from their
+    metadata are marked as skipped, so they are never requested.
+    '''
+    entries = []
+    api_key = None
+    for resource in resources:
+        url = resource.get('url')
+        if resource['url_type'] == 'upload':
+            name = url.split('/')[-1]
+        else:
+            name = resource['name']
+            if os.path.splitext(name)[-1] == '':
+                _format = resource['format']
+                if _format:
+                    name += '.{ext}'.format(ext=_format.lower())
+
+        entry = {'id': resource['id'], 'name': name, 'url': url,
+                 'size': _get_resource_size(resource), 'content_type': None,
+                 'skipped': None}
+        entries.append(entry)
+
+        # Uploaded files are read straight from the storage path instead
+        # of being downloaded from our own site
+        path = _get_upload_path(resource)
+        if path is not None:
+            # Same mimetype CKAN would serve the upload with
+            entry.update(path=path, content_type=(
+                mimetypes.guess_type(url)[0] or 'application/octet-stream'))
+        else:
+            # The API key is only ever sent to our own site
+            headers = {}
+            if _is_own_url(url):
+                api_key = api_key or helpers.get_service_api_key()
+                headers['Authorization'] = api_key
+            entry.update(
+                headers=headers,
+                content_type=_guess_content_type(resource))
+
+        if (entry['content_type'] is not None and
+                entry['content_type'] not in SUPPORTED_RESOURCE_MIMETYPES):
+            entry['skipped'] = 'unsupported_mimetype'
+    return entries
+
+
+def _is_own_url(url):
+    '''Returns True if the URL is on this site (`ckan.site_url`)'''
+    site_url = config.get('ckan.site_url', '').rstrip('/')
+    return bool(site_url and url) and (
+        url == site_url or url.startswith(site_url + '/'))
+
+
+def _get_resource_size(resource):
+    '''Returns the `size` metadata of a resource, None if it is not set'''
+    try:
+        return toolkit.asint(resource.get('size')) or None
+    except (TypeError, ValueError):
+        return None
+
+
+def _guess_content_type(resource):
+    '''Returns the mimetype of a resource from its metadata: the stored
+    mimetype or the one matching its format. None if both are unknown.
+    '''
+    if resource.get('mimetype'):
+        return resource['mimetype'].split(';')[0].strip().lower()
+    if resource.get('format'):
+        return mimetypes.guess_type(
+            'resource.' + resource['format'].lower())[0]
+    return None
+
+
+def _get_compress_type(content_type, compress_level):
+    '''Returns how a resource is written to archives: deflated if it is in
+    a text-like format, stored as it is otherwise
+    '''
+    if compress_level > 0 and content_type in COMPRESSIBLE_RESOURCE_MIMETYPES:
+        return zipfile.ZIP_DEFLATED
+    return zipfile.ZIP_STORED
+
+
+def _show_resources(resource_ids, user=None):
+    '''Returns the resource dicts for the given ids'''
+    return [toolkit.get_action('resource_show')(
+        _get_context(user), {'id': resource_id})
+        for resource_id in resource_ids]
+
+
+def _get_zip_id(file_name, package_id, user=None):
+    '''Returns the zip_id served by `DownloadController.download_zip`'''
     zip_id = file_name
     try:
-        package = toolkit.get_action('package_show')({}, {'id': package_id})
+        package = toolkit.get_action('package_show')(
+            _get_context(user), {'id': package_id})
         package_name = package['name']
 
         zip_id += '::{name}'.format(name=package_name)
     except:
         pass
+    return zip_id
+
+
+def _get_upload_path(resource):
+    '''Returns the path of an uploaded resource within `ckan.storage_path`
+
+    :returns: the file path or None if the resource is not an upload stored
+        on the local filesystem
+    :rtype: string
+    '''
+    if resource.get('url_type') != 'upload':
+        return None
+    # The uploader alters the dict it is given
+    upload = uploader.get_resource_uploader(dict(resource))
+    if not hasattr(upload, 'get_path'):
+        return None
+    path = upload.get_path(resource['id'])
+    if not os.path.isfile(path):
+        return None
+    return path
+
+
+def _get_context(user=None):
+    '''Returns a fresh action context, for the given user if any'''
+    return {'user': user} if user else {}
+
+
+def _open_resource(session, entry, chunk_size):
+    '''Opens a resource for reading, from the local storage or over HTTP.
+    Only resources with a supported mimetype are opened. If it could not be
+    told from the metadata, the mimetype is checked on the response headers
+    and the response is closed before its body is read.
+
+    :returns: the resource id, entry name, mimetype, an iterator over its
+        chunks, its size if known and a function closing the resource. If
+        the resource was not opened, `skipped` holds the reason.
+        `deflated` and `sha256` are only set by `_fetch_resource`.
+    :rtype: dict
+    '''
+    opened = {'id': entry['id'], 'name': entry['name'], 'url': entry['url'],
+              'content_type': entry['content_type'], 'chunks': None,
+              'size': None, 'close': None, 'deflated': None, 'sha256': None,
+              'skipped': entry['skipped']}
+    if opened['skipped'] is not None:
+        return opened
+
+    if entry.get('path'):
+        try:
+            f = open(entry['path'], 'rb')
+        except (IOError, OSError):
+            opened['skipped'] = 'fetch_failed'
+            return opened
+        opened.update(
+            chunks=archive.iter_file(f, chunk_size),
+            size=os.fstat(f.fileno()).st_size, close=f.close)
+        return opened
+
+    try:
+        r = session.get(entry['url'], headers=entry['headers'], stream=True)
+    except Exception:
+        opened['skipped'] = 'fetch_failed'
+        return opened
+
+    if r.status_code >= 400:
+        r.close()
+        # The service API key may have been regenerated
+        if r.status_code in (401, 403) and _is_own_url(entry['url']):
+            helpers.expire_service_api_key()
+        opened['skipped'] = 'fetch_failed'
+        return opened
+
+    if entry['content_type'] is None:
+        content_type = r.headers.get('Content-Type', '').split(';')[0]
+        if content_type not in SUPPORTED_RESOURCE_MIMETYPES:
+            r.close()
+            opened['skipped'] = 'unsupported_mimetype'
+            return opened
+        opened['content_type'] = content_type
+    opened.update(
+        chunks=r.iter_content(chunk_size), size=_get_content_length(r),
+        close=r.close)
+    return opened
 
-    if resourceArchived:
-        return {'zip_id': zip_id}
 
-    os.remove(file_path)
+def _fetch_resource(session, entry, chunk_size, spool_dir, compress_level,
+                    checksum=False):
+    '''Downloads a resource into a spooled temporary file. Runs in the
+    fetch pool of `prepare_zip_resources`. Text-like resources are deflated
+    on the way, so they are compressed in parallel, and `deflated` holds
+    their CRC-32 and compressed size. Other local files are only opened.
+
+    With `checksum`, `sha256` is a hashlib object that is updated with the
+    content of the resource as it is read, and is complete once the
+    resource was written to the archive.
+
+    :returns: same as `_open_resource`
+    :rtype: dict
+    '''
+    opened = _open_resource(session, entry, chunk_size)
+    if opened['skipped'] is not None:
+        return opened
 
-    return {'zip_id': None}
+    if checksum:
+        opened['sha256'] = hashlib.sha256()
+        opened['chunks'] = archive.iter_hashed(
+            opened['chunks'], opened['sha256'])
+
+    compress_type = _get_compress_type(opened['content_type'], compress_level)
+    if compress_type == zipfile.ZIP_DEFLATED:
+        try:
+            body, crc, size, compress_size = archive.deflate(
+                opened['chunks'], compress_level, chunk_size, spool_dir)
+        finally:
+            opened['close']()
+        opened.update(
+            chunks=archive.iter_file(body, chunk_size), size=size,
+            close=body.close, deflated=(crc, compress_size))
+        return opened
+
+    if entry.get('path'):
+        return opened
+
+    try:
+        body, size = archive.spool(opened['chunks'], chunk_size, spool_dir)
+    finally:
+        opened['close']()
+    opened.update(
+        chunks=archive.iter_file(body, chunk_size), size=size,
+        close=body.close)
+    return opened
+
+
+def _get_content_length(response):
+    '''Returns the size announced by the response, None if it is unknown
+    '''
+    if response.headers.get('Content-Encoding'):
+        # Body is decoded while iterating, so the announced size is off
+        return None
+    try:
+        return int(response.headers['Content-Length'])
+    except (KeyError, TypeError, ValueError):
+        return None
 
 
 @toolkit.side_effect_free
@@ -218,52 +919,358 @@ def package_update(context, data_dict):
 
     return dataset_dict
 
+def _expiring_user_capacities(action):
+    '''Returns a chained action for the `action` core action that expires
+    the cached organisation capacities of the users (see
+    `helpers.get_user_capacities`) when it changes the membership of a user
+    '''
+    @toolkit.chained_action
+    def chained_action(up_func, context, data_dict):
+        result = up_func(context, data_dict)
+        if data_dict.get('object_type', 'user') == 'user':
+            helpers.expire_user_capacities()
+        return result
+
+    chained_action.__name__ = action
+    return chained_action
+
+
+member_create = _expiring_user_capacities('member_create')
+member_delete = _expiring_user_capacities('member_delete')
+organization_member_create = _expiring_user_capacities(
+    'organization_member_create')
+organization_member_delete = _expiring_user_capacities(
+    'organization_member_delete')
+# The creator becomes an admin of the new organization
+organization_create = _expiring_user_capacities('organization_create')
+
+
 @toolkit.side_effect_free
 def package_activity_list(context, data_dict):
     '''Override core ckan package_activity_list
+
+    Workflow activities are left out, or only returned when
+    `get_workflow_activities` is set, and so are changes of the
+    `approval_state` extra (see `_get_approval_state_activity_ids`). Accepts the `cursor` parameter, see
+    `_get_activity_page`.
     '''
-    get_workflow_activities = data_dict.get('get_workflow_activities')
-    full_list = core_package_activity_list(context, data_dict)
-    workflow_activities = [
-        a for a in full_list if 'workflow_activity' in a.get('data', {})]
-    normal_activities = [
-        a for a in full_list if 'workflow_activity' not in a.get('data', {})]
-    # Filter out the activities that are related `approval_state`
-    normal_activities = list(filter(
-        lambda activity: core_activity_detail_list(
-            context, {'id': activity['id']}).pop()
-            .get('data', {})
-            .get('package_extra', {})
-            .get('key') != 'approval_state', normal_activities))
-    return (workflow_activities
-        if get_workflow_activities else normal_activities)
+    model = context['model']
+    toolkit.check_access('package_activity_list', context, data_dict)
+    package = model.Package.get(toolkit.get_or_bust(data_dict, 'id'))
+    if package is None:
+        raise toolkit.ObjectNotFound(toolkit._('Dataset not found'))
+
+    query = model.activity._package_activity_query(package.id)
+    get_workflow_activities = toolkit.asbool(
+        data_dict.get('get_workflow_activities', False))
+    if get_workflow_activities:
+        activities = _get_activity_page(
+            context, data_dict, query, workflow=True)
+        return model_dictize.activity_list_dictize(activities, context)
+
+    # Filter out the activities that are related `approval_state`. Pages
+    # selected with a cursor are topped up after the last activity, so they
+    # are still full. Pages selected with an offset are not, as the next
+    # offset would return the same activities again
+    limit = _get_activity_limit(data_dict)
+    activities = []
+    page_dict = dict(data_dict)
+    while True:
+        page = _get_activity_page(context, page_dict, query)
+        approval_state_activity_ids = _get_approval_state_activity_ids(
+            context, [a.id for a in page])
+        activities.extend(
+            a for a in page if a.id not in approval_state_activity_ids)
+        if (not data_dict.get('cursor') or len(activities) >= limit or
+                len(page) < limit):
+            break
+        page_dict['cursor'] = _get_activity_cursor(page[-1])
+    return model_dictize.activity_list_dictize(activities[:limit], context)
+
+
+def _get_approval_state_activity_ids(context, activity_ids):
+    '''Returns the ids of the activities with a detail changing the
+    `approval_state` extra, whatever their other details are. Only the
+    workflow actions change it, on its own, and their steps are shown as
+    workflow activities instead. Creating a dataset adds the extra rather
+    than changing it, so that activity is kept. The details of all the
+    activities are loaded with a single query.
+
+    :param activity_ids: ids of the activities to check
+    :type activity_ids: list
+
+    :returns: ids of the matching activities
+    :rtype: set
+    '''
+    if not activity_ids:
+        return set()
+    model = context['model']
+    details = model.Session.query(
+        model.ActivityDetail.activity_id, model.ActivityDetail.activity_type,
+        model.ActivityDetail.data
+    ).filter(model.ActivityDetail.activity_id.in_(activity_ids))
+
+    return set(
+        activity_id for activity_id, activity_type, data in details
+        if activity_type == 'changed' and
+        (data or {}).get('package_extra', {}).get('key') == 'approval_state')
 
 
 @toolkit.side_effect_free
 def dashboard_activity_list(context, data_dict):
     '''Override core ckan dashboard_activity_list
+
+    Workflow activities are left out. Accepts the `cursor` parameter, see
+    `_get_activity_page`.
     '''
-    full_list = core_dashboard_activity_list(context, data_dict)
-    normal_activities = [
-        a for a in full_list if 'workflow_activity' not in a.get('data', {})]
-    return normal_activities
+    model = context['model']
+    toolkit.check_access('dashboard_activity_list', context, data_dict)
+    user_id = model.User.get(context['user']).id
+
+    query = model.activity._dashboard_activity_query(user_id, None)
+    activity_dicts = model_dictize.activity_list_dictize(
+        _get_activity_page(context, data_dict, query), context)
+
+    # Mark the new (not yet seen by user) activities, as core does
+    last_viewed = model.Dashboard.get(user_id).activity_stream_last_viewed
+    for activity in activity_dicts:
+        if activity['user_id'] == user_id:
+            activity['is_new'] = False
+        else:
+            activity['is_new'] = (
+                _parse_activity_timestamp(activity['timestamp']) >
+                last_viewed)
+    return activity_dicts
 
 
 @toolkit.side_effect_free
 def group_activity_list(context, data_dict):
     '''Override core ckan group_activity_list
+
+    Workflow activities are left out. Accepts the `cursor` parameter, see
+    `_get_activity_page`.
     '''
-    full_list = core_group_activity_list(context, data_dict)
-    normal_activities = [
-        a for a in full_list if 'workflow_activity' not in a.get('data', {})]
-    return normal_activities
+    model = context['model']
+    toolkit.check_access('group_activity_list', context, data_dict)
+    group = model.Group.get(toolkit.get_or_bust(data_dict, 'id'))
+    if group is None:
+        raise toolkit.ObjectNotFound(toolkit._('Group not found'))
+
+    query = model.activity._group_activity_query(group.id)
+    return model_dictize.activity_list_dictize(
+        _get_activity_page(context, data_dict, query), context)
 
 
 @toolkit.side_effect_free
 def recently_changed_packages_activity_list(context, data_dict):
     '''Override core ckan recently_changed_packages_activity_list
+
+    Workflow activities are left out. Accepts the `cursor` parameter, see
+    `_get_activity_page`.
     '''
-    full_list = core_recently_changed_packages_activity_list(context, data_dict)
-    normal_activities = [
-        a for a in full_list if 'workflow_activity' not in a.get('data', {})]
-    return normal_activities
+    model = context['model']
+    query = model.activity._changed_packages_activity_query()
+    return model_dictize.activity_list_dictize(
+        _get_activity_page(context, data_dict, query), context)
+
+
+@toolkit.side_effect_free
+def package_activity_list_html(context, data_dict):
+    '''Override core ckan package_activity_list_html
+
+    Renders the stream of the overridden `package_activity_list`. The
+    rendered stream is cached, see `_get_activity_list_html`.
+    '''
+    model = context['model']
+    toolkit.check_access('package_activity_list', context, data_dict)
+    package = model.Package.get(toolkit.get_or_bust(data_dict, 'id'))
+    if package is None:
+        raise toolkit.ObjectNotFound(toolkit._('Dataset not found'))
+
+    return _get_activity_list_html(
+        context, data_dict, 'package_activity_list', package.id,
+        model.activity._package_activity_query(package.id),
+        {'controller': 'package', 'action': 'activity',
+         'id': data_dict['id']})
+
+
+@toolkit.side_effect_free
+def group_activity_list_html(context, data_dict):
+    '''Override core ckan group_activity_list_html
+
+    Renders the stream of the overridden `group_activity_list`. The
+    rendered stream is cached, see `_get_activity_list_html`.
+    '''
+    model = context['model']
+    toolkit.check_access('group_activity_list', context, data_dict)
+    group = model.Group.get(toolkit.get_or_bust(data_dict, 'id'))
+    if group is None:
+        raise toolkit.ObjectNotFound(toolkit._('Group not found'))
+
+    return _get_activity_list_html(
+        context, data_dict, 'group_activity_list', group.id,
+        model.activity._group_activity_query(group.id),
+        {'controller': 'group', 'action': 'activity',
+         'id': data_dict['id']})
+
+
+@toolkit.side_effect_free
+def dashboard_activity_list_html(context, data_dict):
+    '''Override core ckan dashboard_activity_list_html
+
+    Renders the stream of the overridden `dashboard_activity_list`. The
+    rendered stream is cached, see `_get_activity_list_html`.
+    '''
+    model = context['model']
+    toolkit.check_access('dashboard_activity_list', context, data_dict)
+    user_id = model.User.get(context['user']).id
+
+    # New activities are marked until the user has seen the dashboard
+    last_viewed = model.Dashboard.get(user_id).activity_stream_last_viewed
+    return _get_activity_list_html(
+        context, data_dict, 'dashboard_activity_list', user_id,
+        model.activity._dashboard_activity_query(user_id, None),
+        {'controller': 'user', 'action': 'dashboard',
+         'id': context['user']},
+        extra_key=last_viewed.isoformat())
+
+
+def _get_activity_list_html(context, data_dict, action, object_id, query,
+                            extra_vars, extra_key=''):
+    '''Returns the activities of the `action` list action rendered as HTML.
+
+    Rendered streams are cached in redis, keyed by the object, its latest
+    activity, the requested page, the locale, the permission class of the
+    viewer and the current ACTIVITY_STREAM_CACHE_TTL period. A new activity
+    for the object changes the key, and so does the next period, so the
+    relative times in the stream are never more than one period old. The
+    stream is rendered uncached when redis is unavailable.
+
+    :param object_id: id of the object whose stream is rendered
+    :type object_id: string
+    :param query: query of all the activities of the stream
+    :type query: sqlalchemy.orm.Query
+    :param extra_vars: template variables of the stream
+    :type extra_vars: dict
+    :param extra_key: anything else the rendered stream depends on
+    :type extra_key: string
+
+    :returns: the rendered stream
+    :rtype: literal
+    '''
+    model = context['model']
+    latest = query.order_by(model.Activity.timestamp.desc()).first()
+    page = json.dumps([
+        data_dict.get(key) for key in
+        ('offset', 'limit', 'cursor', 'get_workflow_activities')])
+    key = ':'.join([
+        config.get('ckan.site_id', ''), 'ckanext.ed', 'activity_stream', action,
+        object_id, latest.id if latest else '',
+        hashlib.sha1(page + extra_key).hexdigest(),
+        get_lang(), _get_viewer_class(context),
+        str(int(time.time() // ACTIVITY_STREAM_CACHE_TTL))])
+
+    redis_conn = connect_to_redis()
+    try:
+        html = redis_conn.get(key)
+    except RedisError as e:
+        log.warning('Activity stream cache unavailable: %s', e)
+        redis_conn = html = None
+    if html is not None:
+        return literal(html.decode('utf-8'))
+
+    activity_stream = toolkit.get_action(action)(context, data_dict)
+    extra_vars['offset'] = _get_int(data_dict, 'offset', 0)
+    html = activity_list_to_html(context, activity_stream, extra_vars)
+    if redis_conn is not None:
+        try:
+            redis_conn.set(key, html.encode('utf-8'),
+                           ex=ACTIVITY_STREAM_CACHE_TTL)
+        except RedisError as e:
+            log.warning('Activity stream cache unavailable: %s', e)
+    return html
+
+
+def _get_viewer_class(context):
+    user = context.get('user')
+    if not user:
+        return 'anonymous'
+    if authz.is_sysadmin(user):
+        return 'sysadmin'
+    return 'user'
+
+
+def _get_activity_page(context, data_dict, query, workflow=False):
+    '''Returns a page of the activities of the query, newest first.
+
+    Workflow activities are filtered out in the query (or are the only ones
+    kept, with `workflow`), so pages are always full.
+
+    Pages are selected with `offset` or, for deep pages, with a keyset
+    `cursor`: the "<timestamp>,<id>" of the last activity of the previous
+    page, which does not make the database skip over the previous pages.
+
+    :returns: Activity objects
+    :rtype: list
+    '''
+    model = context['model']
+    limit = _get_activity_limit(data_dict)
+    query = model.activity._filter_activitites_by_users(query)
+
+    # `data` is JSON stored as text. Workflow activities are the only ones
+    # with a `workflow_activity` key
+    data = sqlalchemy.cast(model.Activity.data, sqlalchemy.UnicodeText)
+    is_workflow = data.like('%"workflow_activity"%')
+    query = query.filter(is_workflow if workflow else
+                         sqlalchemy.not_(is_workflow))
+
+    cursor = data_dict.get('cursor')
+    if cursor:
+        timestamp, activity_id = _parse_activity_cursor(cursor)
+        query = query.filter(sqlalchemy.or_(
+            model.Activity.timestamp < timestamp,
+            sqlalchemy.and_(model.Activity.timestamp == timestamp,
+                            model.Activity.id < activity_id)))
+    query = query.order_by(
+        model.Activity.timestamp.desc(), model.Activity.id.desc())
+    if not cursor:
+        query = query.offset(_get_int(data_dict, 'offset', 0))
+    return query.limit(limit).all()
+
+
+def _get_activity_limit(data_dict):
+    limit = _get_int(data_dict, 'limit', toolkit.asint(
+        config.get('ckan.activity_list_limit', 31)))
+    return min(limit, toolkit.asint(
+        config.get('ckan.activity_list_limit_max', 100)))
+
+
+def _get_int(data_dict, key, default):
+    try:
+        value = toolkit.asint(data_dict.get(key, default))
+    except ValueError:
+        value = -1
+    if value < 0:
+        raise toolkit.ValidationError(
+            {key: [toolkit._('Must be a natural number')]})
+    return value
+
+
+def _get_activity_cursor(activity):
+    '''Returns the cursor of the page following the activity'''
+    return '{0},{1}'.format(activity.timestamp.isoformat(), activity.id)
+
+
+def _parse_activity_cursor(cursor):
+    try:
+        timestamp, activity_id = cursor.split(',', 1)
+        return _parse_activity_timestamp(timestamp), activity_id
+    except ValueError:
+        raise toolkit.ValidationError(
+            {'cursor': [toolkit._('Invalid cursor')]})
+
+
+def _parse_activity_timestamp(timestamp):
+    fmt = ('%Y-%m-%dT%H:%M:%S.%f' if '.' in timestamp
+           else '%Y-%m-%dT%H:%M:%S')
+    return datetime.datetime.strptime(timestamp, fmt)
@@ -0,0 +1,901 @@
+'''Helpers for building the zip archives served by the "Download" button.
+
+Zip entries are written from iterables of chunks so that a resource body
+never has to be held in memory as a whole.
+'''
+from collections import deque
+import contextlib
+from multiprocessing.pool import ThreadPool
+import fcntl
+import glob
+import hashlib
+import json
+import logging
+import os
+import re
+import struct
+import tempfile
+import time
+import zipfile
+import zlib
+
+from ckan.common import config
+from ckan.plugins import toolkit
+import requests
+from requests.adapters import HTTPAdapter
+
+from ckanext.ed.helpers import get_storage_path_for
+
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+DEFAULT_FETCH_WORKERS = 4
+DEFAULT_POOL_CONNECTIONS = 10
+DEFAULT_COMPRESS_LEVEL = 6
+DEFAULT_CACHE_MAX_SIZE = 5 * 1024 ** 3
+DEFAULT_CACHE_MAX_AGE = 24 * 60 * 60
+DEFAULT_TTL = 6 * 60 * 60
+DEFAULT_STORAGE_QUOTA = 10 * 1024 ** 3
+DEFAULT_MAX_SIZE = 0
+DEFAULT_MAX_JOBS = 0
+DEFAULT_MAX_JOBS_PER_USER = 0
+DEFAULT_JOB_TIMEOUT = 60 * 60
+CACHE_PREFIX = 'cache-'
+ADMISSION_LOCK = 'admission.lock'
+
+# Local file header and data descriptor signatures (APPNOTE.TXT 4.3.7, 4.3.9)
+_LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+_DATA_DESCRIPTOR_SIGNATURE = b'PK\x07\x08'
+_ZIP64_VERSION = 45
+_FLAG_DATA_DESCRIPTOR = 0x08
+
+_JOB_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+log = logging.getLogger(__name__)
+
+
+def get_chunk_size():
+    '''Returns the buffer size used while streaming resources into archives
+
+    :returns: size of a single chunk in bytes
+    :rtype: integer
+    '''
+    return toolkit.asint(
+        config.get('ckanext.ed.zip.chunk_size', DEFAULT_CHUNK_SIZE))
+
+
+def get_fetch_workers():
+    '''Returns the number of resources downloaded concurrently per archive
+
+    :returns: number of fetch workers
+    :rtype: integer
+    '''
+    return max(1, toolkit.asint(
+        config.get('ckanext.ed.zip.fetch_workers', DEFAULT_FETCH_WORKERS)))
+
+
+def get_compress_level():
+    '''Returns the zlib level text-like resources are deflated with. 0 stores
+    every resource uncompressed.
+
+    :returns: compression level from 0 to 9
+    :rtype: integer
+    '''
+    level = toolkit.asint(config.get(
+        'ckanext.ed.zip.compress_level', DEFAULT_COMPRESS_LEVEL))
+    return min(max(level, 0), 9)
+
+
+def get_http_session():
+    '''Returns a new requests session used to download resources.
+
+    Connections are kept alive and pooled per host. The number of
+    connections to a single host is limited by
+    `ckanext.ed.zip.pool_maxsize`, which defaults to the number of fetch
+    workers.
+
+    :returns: HTTP session
+    :rtype: requests.Session
+    '''
+    pool_connections = toolkit.asint(config.get(
+        'ckanext.ed.zip.pool_connections', DEFAULT_POOL_CONNECTIONS))
+    pool_maxsize = toolkit.asint(config.get(
+        'ckanext.ed.zip.pool_maxsize', get_fetch_workers()))
+    adapter = HTTPAdapter(
+        pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+        pool_block=True)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def imap_ordered(func, items, workers):
+    '''Applies `func` to every item in a pool of threads.
+
+    Results are yielded in the order of `items`. No more than twice the
+    number of workers are scheduled ahead of the consumer, which keeps the
+    number of pending results bounded.
+
+    :param func: function to apply
+    :type func: callable
+    :param items: iterable of arguments for `func`
+    :type items: iterable
+    :param workers: number of threads
+    :type workers: integer
+
+    :returns: generator of results
+    :rtype: generator
+    '''
+    items = iter(items)
+    pool = ThreadPool(workers)
+    pending = deque()
+
+    def schedule(count):
+        for _ in range(count):
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            pending.append(pool.apply_async(func, (item,)))
+
+    try:
+        schedule(workers * 2)
+        while pending:
+            result = pending.popleft().get()
+            schedule(1)
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def spool(chunks, max_size, dirname=None):
+    '''Writes chunks into a temporary file that is kept in memory until it
+    grows over `max_size`.
+
+    :returns: the temporary file rewound to the beginning and its size
+    :rtype: tuple
+    '''
+    body = tempfile.SpooledTemporaryFile(max_size=max_size, dir=dirname)
+    try:
+        for chunk in chunks:
+            body.write(chunk)
+        size = body.tell()
+        body.seek(0)
+    except Exception:
+        body.close()
+        raise
+    return body, size
+
+
+def deflate(chunks, level, max_size, dirname=None):
+    '''Compresses chunks into a temporary file, like `spool`, ready to be
+    written to an archive with `ZipStreamWriter.write_compressed`. zlib
+    releases the GIL while compressing, so resources deflated from the
+    fetch threads are compressed in parallel.
+
+    :returns: the temporary file rewound to the beginning, the CRC-32 and
+        size of the uncompressed data and the compressed size
+    :rtype: tuple
+    '''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    crc = file_size = 0
+    body = tempfile.SpooledTemporaryFile(max_size=max_size, dir=dirname)
+    try:
+        for chunk in chunks:
+            file_size += len(chunk)
+            crc = zlib.crc32(chunk, crc)
+            body.write(compressor.compress(chunk))
+        body.write(compressor.flush())
+        compress_size = body.tell()
+        body.seek(0)
+    except Exception:
+        body.close()
+        raise
+    return body, crc & 0xffffffff, file_size, compress_size
+
+
+def iter_hashed(chunks, digest):
+    '''Updates the digest with every chunk while passing it through, so
+    content is hashed on its way to the archive without a second read
+
+    :param chunks: iterable of byte strings
+    :type chunks: iterable
+    :param digest: a hashlib object
+    '''
+    for chunk in chunks:
+        digest.update(chunk)
+        yield chunk
+
+
+def iter_file(fileobj, chunk_size):
+    '''Yields the content of a file object in chunks'''
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+def _get_status_path(job_id):
+    if not _JOB_ID_RE.match(job_id or ''):
+        return None
+    return os.path.join(
+        get_storage_path_for('temp-ed'), '{0}.json'.format(job_id))
+
+
+def write_status(job_id, status):
+    '''Stores the status of an archive built in the background next to the
+    archive itself, so it can be read by any web worker.
+
+    :param job_id: id of the archive
+    :type job_id: string
+    :param status: JSON serializable status
+    :type status: dict
+    '''
+    path = _get_status_path(job_id)
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(status, f)
+    # Readers never see a partially written status
+    os.rename(tmp_path, path)
+
+
+def read_status(job_id):
+    '''Returns the status of an archive built in the background
+
+    :param job_id: id of the archive
+    :type job_id: string
+
+    :returns: the status or None if there is no such job
+    :rtype: dict
+    '''
+    path = _get_status_path(job_id)
+    if path is None or not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def remove_status(job_id):
+    '''Removes the status of an archive built in the background'''
+    path = _get_status_path(job_id)
+    if path is not None and os.path.isfile(path):
+        os.remove(path)
+
+
+def get_max_size():
+    '''Returns the maximum size of an archive in bytes. 0 means unlimited'''
+    return toolkit.asint(
+        config.get('ckanext.ed.zip.max_size', DEFAULT_MAX_SIZE))
+
+
+def admit_job(job_id, status, user=None):
+    '''Stores the status of a new job, like `write_status`, unless
+    `ckanext.ed.zip.max_jobs` jobs, or `ckanext.ed.zip.max_jobs_per_user`
+    jobs of the user, are already queued or running. 0 means unlimited.
+
+    :param user: name of the user the archive is built for, or any other
+        key the jobs are counted per. Jobs without one only count against
+        `max_jobs`
+    :type user: string
+
+    :returns: None if the job was admitted or the limit that was reached,
+        one of `max_jobs` or `max_jobs_per_user`
+    :rtype: string
+    '''
+    max_jobs = toolkit.asint(
+        config.get('ckanext.ed.zip.max_jobs', DEFAULT_MAX_JOBS))
+    max_jobs_per_user = toolkit.asint(config.get(
+        'ckanext.ed.zip.max_jobs_per_user', DEFAULT_MAX_JOBS_PER_USER))
+
+    with _admission_lock():
+        in_progress = _get_jobs_in_progress(_list_storage()).values()
+        if max_jobs and len(in_progress) >= max_jobs:
+            return 'max_jobs'
+        user_jobs = [s for s in in_progress if s.get('user') == user]
+        if user and max_jobs_per_user and len(user_jobs) >= max_jobs_per_user:
+            return 'max_jobs_per_user'
+        status = dict(status, user=user)
+        write_status(job_id, status)
+    return None
+
+
+@contextlib.contextmanager
+def _admission_lock():
+    # Serializes admissions across all web and job worker processes
+    lock_path = os.path.join(get_storage_path_for('temp-ed'), ADMISSION_LOCK)
+    with open(lock_path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _get_jobs_in_progress(files):
+    '''Returns the statuses of queued and running jobs by job id. Jobs
+    whose status was not updated for `ckanext.ed.zip.job_timeout` seconds
+    are considered dead.
+
+    :param files: the files of the temp-ed storage as listed by
+        `_list_storage`
+    :type files: list
+    '''
+    timeout = toolkit.asint(
+        config.get('ckanext.ed.zip.job_timeout', DEFAULT_JOB_TIMEOUT))
+    now = time.time()
+    in_progress = {}
+    for modified_at, _, _, file_name in files:
+        job_id, ext = os.path.splitext(file_name)
+        if ext != '.json' or now - modified_at > timeout:
+            continue
+        try:
+            status = read_status(job_id) or {}
+        except (IOError, ValueError):
+            continue
+        if status.get('state') in ('queued', 'running'):
+            in_progress[job_id] = status
+    return in_progress
+
+
+def is_cache_enabled():
+    '''Returns True if prepared archives are kept for reuse'''
+    return toolkit.asbool(config.get('ckanext.ed.zip.cache_enabled', True))
+
+
+def is_precompute_enabled():
+    '''Returns True if archives of whole datasets are built in advance'''
+    return (is_cache_enabled() and
+            toolkit.asbool(config.get('ckanext.ed.zip.precompute', False)))
+
+
+def get_cache_key(resources, manifest=False):
+    '''Returns the cache key of an archive of the given resources.
+
+    The key only depends on the set of resources and their versions, so
+    it changes whenever one of them is modified.
+
+    :param resources: resource dicts
+    :type resources: list
+    :param manifest: whether the archive includes a manifest
+    :type manifest: boolean
+
+    :returns: the cache key
+    :rtype: string
+    '''
+    versions = sorted(
+        '{0}:{1}:{2}'.format(
+            resource['id'],
+            resource.get('last_modified') or '',
+            resource.get('revision_id') or '')
+        for resource in resources)
+    if manifest:
+        versions.append('manifest')
+    return hashlib.sha1('\n'.join(versions).encode('utf-8')).hexdigest()
+
+
+def get_archive_name(name, checksum=None):
+    '''Returns the file name of a complete archive. The checksum of the
+    archive is part of the name, so it never has to be read again.
+
+    :param name: job id or cache file name prefix
+    :type name: string
+    :param checksum: SHA-256 of the archive
+    :type checksum: string
+
+    :returns: the file name
+    :rtype: string
+    '''
+    return '.'.join(part for part in (name, checksum, 'zip') if part)
+
+
+def get_archive_checksum(file_name):
+    '''Returns the SHA-256 of an archive from its file name, None if it is
+    not known'''
+    parts = file_name.split('.')
+    return parts[1] if len(parts) == 3 else None
+
+
+def is_cached_file(file_name):
+    '''Returns True if the archive belongs to the cache and must be kept
+    after it is served'''
+    return file_name.startswith(CACHE_PREFIX)
+
+
+def get_cached_archive(key):
+    '''Returns the file name of the cached archive for the key, if any.
+    Marks the archive as recently used.
+
+    Archives older than `ckanext.ed.zip.cache_max_age` seconds are not
+    returned however often they are used, so that linked resources, whose
+    versions do not change with the remote files, are downloaded again.
+
+    :param key: cache key from `get_cache_key`
+    :type key: string
+
+    :returns: file name within the temp-ed storage or None
+    :rtype: string
+    '''
+    if not is_cache_enabled():
+        return None
+    max_age = _get_cache_max_age()
+    for file_path in _find_cached_archives(key):
+        # The modification time is when the archive was created, the access
+        # time when it was last used
+        try:
+            created_at = os.stat(file_path).st_mtime
+            if time.time() - created_at > max_age:
+                continue
+            os.utime(file_path, (time.time(), created_at))
+        except OSError:
+            continue
+        return os.path.basename(file_path)
+    return None
+
+
+def store_in_cache(file_path, key):
+    '''Moves a complete archive to the cache and evicts old entries.
+
+    :param file_path: path of the archive
+    :type file_path: string
+    :param key: cache key from `get_cache_key`
+    :type key: string
+
+    :returns: the file name the archive is now available under
+    :rtype: string
+    '''
+    if not is_cache_enabled():
+        return os.path.basename(file_path)
+    # Archives of the same resources built concurrently are replaced
+    for cached_path in _find_cached_archives(key):
+        _remove(cached_path)
+    file_name = get_archive_name(
+        CACHE_PREFIX + key,
+        get_archive_checksum(os.path.basename(file_path)))
+    os.rename(
+        file_path,
+        os.path.join(os.path.dirname(file_path), file_name))
+    evict_cache()
+    return file_name
+
+
+def _find_cached_archives(key):
+    pattern = os.path.join(
+        get_storage_path_for('temp-ed'), CACHE_PREFIX + key + '.*')
+    return glob.glob(pattern)
+
+
+def evict_cache():
+    '''Removes cached archives created more than
+    `ckanext.ed.zip.cache_max_age` seconds ago and then the least recently
+    used ones until the cache fits into `ckanext.ed.zip.cache_max_size`
+    bytes.
+    '''
+    max_size = toolkit.asint(
+        config.get('ckanext.ed.zip.cache_max_size', DEFAULT_CACHE_MAX_SIZE))
+    max_age = _get_cache_max_age()
+    now = time.time()
+
+    cached = []
+    for created_at, size, file_path, file_name in _list_storage():
+        if not is_cached_file(file_name):
+            continue
+        try:
+            used_at = os.stat(file_path).st_atime
+        except OSError:
+            continue
+        cached.append((used_at, created_at, size, file_path))
+    total_size = sum(f[2] for f in cached)
+    # Least recently used first
+    for used_at, created_at, size, file_path in sorted(cached):
+        if now - created_at <= max_age and total_size <= max_size:
+            continue
+        if _remove(file_path):
+            total_size -= size
+
+
+def _get_cache_max_age():
+    return toolkit.asint(
+        config.get('ckanext.ed.zip.cache_max_age', DEFAULT_CACHE_MAX_AGE))
+
+
+def get_storage_quota():
+    '''Returns the maximum size of the temp-ed storage in bytes. 0 or less
+    means unlimited.
+    '''
+    return toolkit.asint(config.get(
+        'ckanext.ed.zip.storage_quota', DEFAULT_STORAGE_QUOTA))
+
+
+def cleanup_storage():
+    '''Removes archives, and their job statuses, that were not downloaded
+    within `ckanext.ed.zip.ttl` seconds and evicts the archive cache. Then
+    removes the oldest files until the temp-ed storage fits into
+    `ckanext.ed.zip.storage_quota` bytes, unless it is 0 or less. Archives
+    of jobs in progress are kept.
+
+    :returns: the size of the temp-ed storage in bytes after the cleanup
+    :rtype: integer
+    '''
+    ttl = toolkit.asint(config.get('ckanext.ed.zip.ttl', DEFAULT_TTL))
+    quota = get_storage_quota()
+    now = time.time()
+    evict_cache()
+
+    files = _list_storage()
+    in_progress = _get_jobs_in_progress(files)
+
+    total_size = sum(f[1] for f in files)
+    # Oldest first
+    for modified_at, size, file_path, file_name in sorted(files):
+        if file_name == ADMISSION_LOCK:
+            continue
+        expired = (not is_cached_file(file_name) and
+                   now - modified_at > ttl)
+        if not expired and (quota <= 0 or total_size <= quota or
+                            file_name.split('.')[0] in in_progress):
+            continue
+        if _remove(file_path):
+            total_size -= size
+    return total_size
+
+
+def _list_storage():
+    '''Returns the modification time, size, path and name of every file in
+    the temp-ed storage
+    '''
+    storage_path = get_storage_path_for('temp-ed')
+    files = []
+    for file_name in os.listdir(storage_path):
+        file_path = os.path.join(storage_path, file_name)
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            continue
+        if os.path.isfile(file_path):
+            files.append((stat.st_mtime, stat.st_size, file_path, file_name))
+    return files
+
+
+def _remove(file_path):
+    try:
+        os.remove(file_path)
+    except OSError as e:
+        log.warning('Could not remove %s: %s', file_path, e)
+        return False
+    return True
+
+
+def get_offload_header(file_name):
+    '''Returns the header that makes the web server send an archive, if
+    `ckanext.ed.zip.offload` is set.
+
+    With `x-accel-redirect` (nginx) the header points to the archive under
+    the internal location `ckanext.ed.zip.offload_location`, which has to
+    be an alias of the temp-ed storage directory. With `x-sendfile`
+    (Apache, lighttpd) it holds the full path of the archive.
+
+    :param file_name: file name of the archive within the temp-ed storage
+    :type file_name: string
+
+    :returns: header name and value or None
+    :rtype: tuple
+    '''
+    offload = config.get('ckanext.ed.zip.offload', '').lower()
+    if offload == 'x-accel-redirect':
+        location = config.get('ckanext.ed.zip.offload_location', '/temp-ed/')
+        return 'X-Accel-Redirect', location.rstrip('/') + '/' + file_name
+    if offload == 'x-sendfile':
+        return 'X-Sendfile', os.path.join(
+            get_storage_path_for('temp-ed'), file_name)
+    return None
+
+
+class FileIter(object):
+    '''WSGI application iterator over a file, read in chunks.
+
+    Implements `app_iter_range` so that WebOb answers HTTP Range requests
+    by seeking instead of reading through the skipped bytes.
+    '''
+    def __init__(self, fileobj, chunk_size=DEFAULT_CHUNK_SIZE,
+                 start=0, stop=None):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.start = start
+        self.stop = stop
+
+    def __iter__(self):
+        self.fileobj.seek(self.start)
+        remaining = None if self.stop is None else self.stop - self.start
+        while remaining is None or remaining > 0:
+            size = self.chunk_size
+            if remaining is not None:
+                size = min(size, remaining)
+            chunk = self.fileobj.read(size)
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
+
+    def app_iter_range(self, start, stop):
+        return FileIter(self.fileobj, self.chunk_size, start, stop)
+
+    def close(self):
+        self.fileobj.close()
+
+
+class ClosingIter(object):
+    '''WSGI application iterator calling `on_close` once the server closes
+    it, even if the response body was never iterated (HEAD requests,
+    clients that disconnect before the body starts).
+    '''
+    def __init__(self, iterable, on_close):
+        self.iterable = iterable
+        self.on_close = on_close
+
+    def __iter__(self):
+        return iter(self.iterable)
+
+    def close(self):
+        try:
+            close = getattr(self.iterable, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            self.on_close()
+
+def iter_zip_stream(entries, compression=zipfile.ZIP_STORED,
+                    compress_level=zlib.Z_DEFAULT_COMPRESSION):
+    '''Yields a zip archive of the entries while it is being written,
+    without storing it anywhere.
+
+    :param entries: iterable of (name, chunks, size, compress_type) tuples.
+        See `ZipStreamWriter.write_iter`
+    :type entries: iterable
+    :param compression: default compression of the entries
+    :type compression: integer
+    :param compress_level: zlib level of deflated entries
+    :type compress_level: integer
+
+    :returns: generator of byte strings
+    :rtype: generator
+    '''
+    output = _StreamBuffer()
+    writer = ZipStreamWriter(output, compression, compress_level)
+    for name, chunks, size, compress_type in entries:
+        for _ in writer.iter_write(name, chunks, size, compress_type):
+            data = output.drain()
+            if data:
+                yield data
+    writer.close()
+    yield output.drain()
+
+
+class _StreamBuffer(object):
+    '''Collects the data written to it until it is drained'''
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(data)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+class _PositionTracker(object):
+    '''Wraps a writable file object and keeps track of the written bytes so
+    that archives can be written to streams that do not support `tell()`.
+    The written bytes are hashed along the way.
+    '''
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self._position = 0
+        self.digest = hashlib.sha256()
+
+    def write(self, data):
+        self._fileobj.write(data)
+        self._position += len(data)
+        self.digest.update(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        if hasattr(self._fileobj, 'flush'):
+            self._fileobj.flush()
+
+
+class ZipStreamWriter(object):
+    '''Writes zip archives entry by entry from iterables of chunks.
+
+    Every entry is written with a data descriptor, so the output is never
+    seeked and the CRC and sizes are only needed once the entry is complete.
+    The central directory (including Zip64 records for big entries and
+    archives) is written by `zipfile.ZipFile` when the writer is closed.
+
+    :param fileobj: writable file-like object. Does not need to be seekable.
+    :type fileobj: file
+    :param compression: default compression for entries. One of
+        `zipfile.ZIP_STORED` or `zipfile.ZIP_DEFLATED`
+    :type compression: integer
+    :param compress_level: zlib level of deflated entries
+    :type compress_level: integer
+    '''
+    def __init__(self, fileobj, compression=zipfile.ZIP_STORED,
+                 compress_level=zlib.Z_DEFAULT_COMPRESSION):
+        self._fp = _PositionTracker(fileobj)
+        self._zip = zipfile.ZipFile(
+            self._fp, 'w', compression, allowZip64=True)
+        self.compression = compression
+        self.compress_level = compress_level
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def bytes_written(self):
+        '''Number of bytes written to the output so far'''
+        return self._fp.tell()
+
+    @property
+    def checksum(self):
+        '''SHA-256 of the output so far, of the whole archive once the
+        writer is closed'''
+        return self._fp.digest.hexdigest()
+
+    def write_iter(self, name, chunks, size=None, compress_type=None):
+        '''Writes a new entry to the archive.
+
+        :param name: name of the entry within the archive
+        :type name: string
+        :param chunks: iterable of byte strings with the entry content
+        :type chunks: iterable
+        :param size: expected size of the entry, if known. Entries with an
+            unknown size, or a size close to 4 GB, get Zip64 local headers.
+        :type size: integer
+        :param compress_type: overrides the archive default compression
+        :type compress_type: integer
+
+        :returns: the information about the written entry
+        :rtype: zipfile.ZipInfo
+        '''
+        for zinfo in self.iter_write(name, chunks, size, compress_type):
+            pass
+        return zinfo
+
+    def iter_write(self, name, chunks, size=None, compress_type=None):
+        '''Same as `write_iter` but yields every time data is written to
+        the output, so that callers can forward it while the entry is being
+        written. Yields None except for the last time, when the information
+        about the written entry is yielded.
+        '''
+        zinfo = self._new_zinfo(name, compress_type)
+        zip64 = size is None or size * 1.05 > zipfile.ZIP64_LIMIT
+        self._write_local_header(zinfo, zip64)
+        yield None
+
+        compressor = None
+        if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+            compressor = zlib.compressobj(
+                self.compress_level, zlib.DEFLATED, -15)
+
+        crc = file_size = compress_size = 0
+        for chunk in chunks:
+            if not chunk:
+                continue
+            file_size += len(chunk)
+            crc = zlib.crc32(chunk, crc)
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+                if not chunk:
+                    continue
+            compress_size += len(chunk)
+            self._fp.write(chunk)
+            yield None
+        if compressor is not None:
+            chunk = compressor.flush()
+            compress_size += len(chunk)
+            self._fp.write(chunk)
+
+        zinfo.CRC = crc & 0xffffffff
+        zinfo.file_size = file_size
+        zinfo.compress_size = compress_size
+        if not zip64 and max(file_size, compress_size) > zipfile.ZIP64_LIMIT:
+            raise zipfile.LargeZipFile(
+                'Entry %s exceeds the size it was announced with' % name)
+        self._write_data_descriptor(zinfo, zip64)
+        self._register(zinfo)
+        yield zinfo
+
+    def write_compressed(self, name, chunks, crc, file_size, compress_size,
+                         compress_type=zipfile.ZIP_DEFLATED):
+        '''Writes a new entry whose content is already compressed, e.g. by
+        `deflate`.
+
+        :param chunks: iterable of byte strings with the compressed content
+        :type chunks: iterable
+        :param crc: CRC-32 of the uncompressed content
+        :type crc: integer
+        :param file_size: size of the uncompressed content
+        :type file_size: integer
+        :param compress_size: size of the compressed content
+        :type compress_size: integer
+
+        :returns: the information about the written entry
+        :rtype: zipfile.ZipInfo
+        '''
+        zinfo = self._new_zinfo(name, compress_type)
+        zip64 = max(file_size, compress_size) > zipfile.ZIP64_LIMIT
+        self._write_local_header(zinfo, zip64)
+
+        written = 0
+        for chunk in chunks:
+            written += len(chunk)
+            self._fp.write(chunk)
+        if written != compress_size:
+            raise ValueError(
+                'Entry %s does not match its compressed size' % name)
+
+        zinfo.CRC = crc
+        zinfo.file_size = file_size
+        zinfo.compress_size = compress_size
+        self._write_data_descriptor(zinfo, zip64)
+        self._register(zinfo)
+        return zinfo
+
+    def close(self):
+        '''Writes the central directory. The wrapped file object is left open.
+        '''
+        self._zip.close()
+
+    def _new_zinfo(self, name, compress_type):
+        zinfo = zipfile.ZipInfo(name, time.localtime(time.time())[:6])
+        zinfo.compress_type = (self.compression
+                               if compress_type is None else compress_type)
+        zinfo.external_attr = 0o600 << 16
+        zinfo.header_offset = self._fp.tell()
+        return zinfo
+
+    def _write_local_header(self, zinfo, zip64):
+        filename, flag_bits = zinfo._encodeFilenameFlags()
+        zinfo.flag_bits = flag_bits | _FLAG_DATA_DESCRIPTOR
+        extra = b''
+        size_placeholder = 0
+        if zip64:
+            # Sizes are only known once the data descriptor is written
+            extra = struct.pack('<HHQQ', 1, 16, 0, 0)
+            size_placeholder = 0xffffffff
+            zinfo.extract_version = max(_ZIP64_VERSION, zinfo.extract_version)
+            zinfo.create_version = max(_ZIP64_VERSION, zinfo.create_version)
+        dt = zinfo.date_time
+        dosdate = (dt[0] - 1980) << 9 | dt[1] << 5 | dt[2]
+        dostime = dt[3] << 11 | dt[4] << 5 | (dt[5] // 2)
+        header = struct.pack(
+            zipfile.structFileHeader, _LOCAL_HEADER_SIGNATURE,
+            zinfo.extract_version, zinfo.reserved, zinfo.flag_bits,
+            zinfo.compress_type, dostime, dosdate, 0,
+            size_placeholder, size_placeholder, len(filename), len(extra))
+        self._fp.write(header + filename + extra)
+
+    def _write_data_descriptor(self, zinfo, zip64):
+        fmt = '<4sLQQ' if zip64 else '<4sLLL'
+        self._fp.write(struct.pack(
+            fmt, _DATA_DESCRIPTOR_SIGNATURE, zinfo.CRC,
+            zinfo.compress_size, zinfo.file_size))
+
+    def _register(self, zinfo):
+        # Let ZipFile write the central directory for the entry on close
+        self._zip.filelist.append(zinfo)
+        self._zip.NameToInfo[zinfo.filename] = zinfo
+        self._zip._didModify = True
+        if hasattr(self._zip, 'start_dir'):
+            self._zip.start_dir = self._fp.tell()
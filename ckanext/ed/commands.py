@@ -0,0 +1,59 @@
+import sys
+
+from ckan.lib.cli import CkanCommand
+
+from ckanext.ed import archive, helpers
+from ckanext.ed import model as ed_model
+
+
+class EDCommand(CkanCommand):
+    '''Maintenance commands for the ED extension
+
+    Usage:
+
+        paster ed cleanup_zips -c <path to config file>
+            - Removes expired zip archives and keeps the storage for them
+              under the configured quota
+
+        paster ed initdb -c <path to config file>
+            - Creates the tables of the extension
+
+        paster ed backfill_workflow_transitions -c <path to config file>
+            - Records the workflow transitions of existing workflow
+              activities in the workflow transition table and drops the
+              cached rejection feedback
+    '''
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+    max_args = 1
+    min_args = 1
+
+    def command(self):
+        self._load_config()
+        cmd = self.args[0]
+
+        if cmd == 'cleanup_zips':
+            self.cleanup_zips()
+        elif cmd == 'initdb':
+            ed_model.setup()
+            print('Tables created')
+        elif cmd == 'backfill_workflow_transitions':
+            ed_model.setup()
+            count = ed_model.backfill_workflow_transitions()
+            # Lookups made before the backfill cached "no rejection"
+            if count:
+                helpers.expire_latest_rejection_feedback()
+            print('{0} workflow transitions recorded'.format(count))
+        else:
+            print('Command {0} not recognized'.format(cmd))
+            sys.exit(1)
+
+    def cleanup_zips(self):
+        total_size = archive.cleanup_storage()
+        quota = archive.get_storage_quota()
+        if quota <= 0:
+            print('Zip storage uses {0} bytes'.format(total_size))
+            return
+        print('Zip storage uses {0} of {1} bytes'.format(total_size, quota))
+        if total_size > quota:
+            print('Quota exceeded by archives of jobs in progress')
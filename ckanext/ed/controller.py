@@ -19,6 +19,7 @@ from ckan.views.user import _extra_template_variables
 import ckan.lib.navl.dictization_functions as dict_fns
 
 
+from ckanext.ed import actions, archive
 from ckanext.ed.helpers import get_storage_path_for, get_pending_datasets, is_admin, workflow_activity_create
 from ckanext.ed.mailer import mail_package_publish_update_to_user, mail_package_publish_request_to_admins
 from ckan.controllers.package import PackageController
@@ -492,11 +493,24 @@ class DashboardTopicsController(base.BaseController):
 class DownloadController(base.BaseController):
     def download_zip(self, zip_id):
         '''Downloads dataset
+
+        The archive is streamed in chunks and supports HTTP Range requests.
+        If `ckanext.ed.zip.offload` is set, the file is served by the web
+        server through X-Accel-Redirect/X-Sendfile instead. Archives are kept
+        until the storage cleanup removes them, so that interrupted downloads
+        can be resumed.
         '''
         if not zip_id:
             toolkit.abort(404, toolkit._('Data not found'))
         file_name, package_name = zip_id.split('::')
-        file_path = get_storage_path_for('temp-ed/' + file_name)
+        file_name = os.path.basename(file_name)
+        file_path = os.path.join(get_storage_path_for('temp-ed'), file_name)
+        job_id = file_name.split('.')[0]
+
+        # Archives built in the background are served once they are ready
+        status = archive.read_status(job_id)
+        if status is not None and status['state'] != 'finished':
+            toolkit.abort(409, toolkit._('Data is not ready yet'))
 
         if not os.path.isfile(file_path):
             toolkit.abort(404, toolkit._('Data not found'))
@@ -505,12 +519,59 @@ class DownloadController(base.BaseController):
             package_name = 'resources'
         package_name += '.zip'
 
-        with open(file_path, 'r') as f:
-            response.write(f.read())
-
         response.headers['Content-Type'] = 'application/octet-stream'
         response.content_disposition = 'attachment; filename=' + package_name
-        os.remove(file_path)
+        # Archives are never modified, so their checksum is a strong ETag
+        checksum = archive.get_archive_checksum(file_name)
+        if checksum is not None:
+            response.etag = checksum
+
+        offload_header = archive.get_offload_header(file_name)
+        if offload_header is not None:
+            # The web server serves the file (including ranges)
+            response.headers[offload_header[0]] = offload_header[1]
+            return
+
+        f = open(file_path, 'rb')
+        response.content_length = os.fstat(f.fileno()).st_size
+        response.headers['Accept-Ranges'] = 'bytes'
+        response.conditional_response = True
+        file_wrapper = request.environ.get('wsgi.file_wrapper')
+        if file_wrapper is not None and 'HTTP_RANGE' not in request.environ:
+            response.app_iter = file_wrapper(f, archive.get_chunk_size())
+        else:
+            response.app_iter = archive.FileIter(f, archive.get_chunk_size())
+
+    def stream_zip(self):
+        '''Downloads the resources given in the `resources` parameter as a
+        zip archive that is streamed while it is built, without preparing it
+        under the storage path first
+        '''
+        resource_ids = request.params.getall('resources')
+        if not resource_ids:
+            toolkit.abort(400, toolkit._('No resources selected'))
+
+        context = {'model': model, 'user': c.user, 'auth_user_obj': c.userobj}
+        try:
+            resources = [
+                get_action('resource_show')(dict(context), {'id': resource_id})
+                for resource_id in resource_ids]
+            package = get_action('package_show')(
+                dict(context), {'id': resources[0]['package_id']})
+        except (NotFound, toolkit.ObjectNotFound):
+            toolkit.abort(404, toolkit._('Data not found'))
+        except (NotAuthorized, toolkit.NotAuthorized):
+            toolkit.abort(403, toolkit._('Not authorized to see this page'))
+
+        try:
+            app_iter = actions.stream_zip_resources(resources, user=c.user)
+        except toolkit.ValidationError as e:
+            toolkit.abort(409, e.error_dict['resources'][0])
+
+        response.headers['Content-Type'] = 'application/octet-stream'
+        response.content_disposition = (
+            'attachment; filename=' + package['name'] + '.zip')
+        response.app_iter = app_iter
 
 
 class StateUpdateController(base.BaseController):
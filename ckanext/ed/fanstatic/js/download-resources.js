@@ -43,9 +43,48 @@ $(document).ready(function () {
     toggleDownloadButton();
   });
 
+  var resetDownloadButton = function() {
+    downloadResourcesBtn.removeAttr('disabled');
+    downloadResourcesBtn.text(_('Download'));
+  };
+
+  var downloadZip = function(zip_id) {
+    if (zip_id) {
+      clickLinkInBackground(window.location.origin + '/download/zip/' + zip_id);
+    } else {
+      window.ckan.notify(_('Could not create a zip archive.'));
+    }
+  };
+
+  // The archive is built in a background job, poll its status until it is ready
+  var pollZipStatus = function(job_id) {
+    var url = window.location.origin + '/api/action/ed_zip_status';
+
+    $.get(url, { id: job_id }, function (response) {
+      var status = response.result;
+
+      if (status.state === 'finished') {
+        resetDownloadButton();
+        downloadZip(status.zip_id);
+      } else if (status.state === 'failed') {
+        resetDownloadButton();
+        window.ckan.notify(_('An error occured while preparing zip archive.'));
+      } else {
+        downloadResourcesBtn.text(
+          _('Preparing zip archive...') + ' ' +
+          status.resources_done + '/' + status.resources_total
+        );
+        setTimeout(function() { pollZipStatus(job_id); }, 2000);
+      }
+    }).error(function (response) {
+      resetDownloadButton();
+      window.ckan.notify(_('An error occured while preparing zip archive.'));
+    });
+  };
+
   downloadResourcesBtn.click(function (e) {
     var url = window.location.origin + '/api/action/ed_prepare_zip_resources';
-    var data = { resources: [] };
+    var data = { resources: [], background: true };
 
     downloadResourcesBtn.attr('disabled', 'disabled');
     downloadResourcesBtn.text(_('Preparing zip archive...'));
@@ -57,27 +96,23 @@ $(document).ready(function () {
     });
 
     $.post(url, JSON.stringify(data), function (response) {
-      var zip_id = response.result.zip_id;
-
-      downloadResourcesBtn.removeAttr('disabled');
-      downloadResourcesBtn.text(_('Download'));
-
-      if (zip_id) {
-        var link = document.createElement('a');
-        url = window.location.origin + '/download/zip/' + zip_id;
-        link.style.display = 'none';
-        link.href = url;
-        document.body.appendChild(link);
-        link.click();
-        document.body.removeChild(link);
+      if (response.result.job_id) {
+        pollZipStatus(response.result.job_id);
       } else {
-        window.ckan.notify(_('Could not create a zip archive.'));
+        // Served straight from the cache of prepared archives
+        resetDownloadButton();
+        downloadZip(response.result.zip_id);
       }
     }).error(function (response) {
-      downloadResourcesBtn.removeAttr('disabled');
-      downloadResourcesBtn.text(_('Download'));
+      var error = response.responseJSON && response.responseJSON.error;
+      resetDownloadButton();
 
-      window.ckan.notify(_('An error occured while preparing zip archive.'));
+      // Selections over the size or concurrency limits are refused up front
+      if (error && error.resources) {
+        window.ckan.notify(error.resources[0]);
+      } else {
+        window.ckan.notify(_('An error occured while preparing zip archive.'));
+      }
     });
   });
 
@@ -3,13 +3,41 @@ import json
 import inspect
 import logging
 import os
+import threading
+import time
 
+from ckan import model
 from ckan.common import config, is_flask_request, c, request
+from ckan.lib.redis import connect_to_redis
 from ckan.plugins import toolkit
+from redis.exceptions import RedisError
+
+from ckanext.ed.model import (
+    WorkflowTransition, get_cache_generation, increment_cache_generation)
 
 
 log = logging.getLogger()
 
+DEFAULT_SERVICE_API_KEY_TTL = 5 * 60
+# Datasets that are no longer looked at drop out of the cache eventually
+LATEST_REJECTION_CACHE_TTL = 24 * 60 * 60
+DEFAULT_HOMEPAGE_CACHE_TTL = 5 * 60
+# Set when the homepage datasets are dropped once the session is committed
+HOMEPAGE_SESSION_KEY = 'ckanext.ed.expire_homepage'
+# Search index fields of the quality marks
+QUALITY_MARK_FIELDS = {
+    'machine': 'machine_readable',
+    'doc': 'has_documentation',
+}
+
+DEFAULT_USER_CAPACITIES_TTL = 5 * 60
+USER_CAPACITIES_GENERATION = 'user_capacities'
+
+_service_api_key = {'key': None, 'expires': 0}
+_service_api_key_lock = threading.Lock()
+_user_capacities = {}
+_user_capacities_lock = threading.Lock()
+
 
 def _get_action(action, context_dict, data_dict):
     return toolkit.get_action(action)(context_dict, data_dict)
@@ -38,9 +66,15 @@ def get_recently_updated_datasets(limit=5):
     :param user: user name
     :type user: string
 
-    :returns: a list of recently created or updated datasets
+    :returns: a list of recently created or updated datasets, see
+        `_get_homepage_datasets`
     :rtype: list
     '''
+    return _get_homepage_datasets(
+        'recently_updated', limit, _search_recently_updated_datasets)
+
+
+def _search_recently_updated_datasets(limit):
     try:
         pkg_search_results = toolkit.get_action('package_search')(
             data_dict={
@@ -63,9 +97,14 @@ def get_most_popular_datasets(limit=5):
     :param user: user name
     :type user: string
 
-    :returns: a list of most popular datasets
+    :returns: a list of most popular datasets, see `_get_homepage_datasets`
     :rtype: list
     '''
+    return _get_homepage_datasets(
+        'most_popular', limit, _search_most_popular_datasets)
+
+
+def _search_most_popular_datasets(limit):
     data = pkg_search_results = toolkit.get_action('package_search')(
         data_dict={
             'sort': 'views_total desc',
@@ -75,6 +114,65 @@ def get_most_popular_datasets(limit=5):
     return data
 
 
+def _get_homepage_datasets(widget, limit, search_datasets):
+    '''Returns the datasets listed by a homepage widget, with only the
+    fields the widget shows (id, name, title and organization title). They
+    are cached for `ckanext.ed.homepage_cache_ttl` seconds or until a
+    dataset is created, updated or deleted, see
+    `expire_homepage_datasets`.
+    '''
+    ttl = toolkit.asint(config.get(
+        'ckanext.ed.homepage_cache_ttl', DEFAULT_HOMEPAGE_CACHE_TTL))
+    if not ttl:
+        return _trim_homepage_datasets(search_datasets(limit))
+
+    redis_conn = connect_to_redis()
+    key = _get_homepage_datasets_cache_key()
+    field = '{0}:{1}'.format(widget, limit)
+    cached = redis_conn.hget(key, field)
+    if cached is not None:
+        cached = json.loads(cached)
+        if time.time() < cached['expires']:
+            return cached['datasets']
+
+    datasets = _trim_homepage_datasets(search_datasets(limit))
+    redis_conn.hset(key, field, json.dumps({
+        'datasets': datasets,
+        'expires': time.time() + ttl,
+    }))
+    redis_conn.expire(key, ttl)
+    return datasets
+
+
+def _trim_homepage_datasets(datasets):
+    return [{
+        'id': dataset['id'],
+        'name': dataset['name'],
+        'title': dataset['title'],
+        'organization': {
+            'title': dataset['organization']['title']
+        } if dataset.get('organization') else None,
+    } for dataset in datasets]
+
+
+def expire_homepage_datasets():
+    '''Drops the cached datasets of the homepage widgets'''
+    connect_to_redis().delete(_get_homepage_datasets_cache_key())
+
+
+def expire_homepage_datasets_on_commit():
+    '''Drops the cached datasets of the homepage widgets once the session is
+    committed, so that they are not cached again from the previous version
+    of the datasets in the meantime (see `actions.listen_for_commits`)
+    '''
+    model.Session.info[HOMEPAGE_SESSION_KEY] = True
+
+
+def _get_homepage_datasets_cache_key():
+    return '{0}:ckanext.ed:homepage_datasets'.format(
+        config.get('ckan.site_id'))
+
+
 def get_storage_path_for(dirname):
     """Returns the full path for the specified directory name within
     CKAN's storage path. If the target directory does not exists, it
@@ -101,8 +199,56 @@ def get_storage_path_for(dirname):
     return target_path
 
 
+def get_service_api_key(refresh=False):
+    """Returns the API key used to fetch resources from this site, e.g.
+    while preparing zip archives. It is `ckanext.ed.service_api_key` if set,
+    otherwise the key of the `ckanext.ed.service_user` user or of the first
+    sysadmin, looked up at most once every `ckanext.ed.service_api_key_ttl`
+    seconds.
+
+    :param refresh: look the key up again even if it is cached
+    :type refresh: boolean
+
+    :returns: the API key or None if there is no service user
+    :rtype: string
+    """
+    key = config.get('ckanext.ed.service_api_key')
+    if key:
+        return key
+
+    ttl = toolkit.asint(config.get(
+        'ckanext.ed.service_api_key_ttl', DEFAULT_SERVICE_API_KEY_TTL))
+    with _service_api_key_lock:
+        if refresh or time.time() >= _service_api_key['expires']:
+            _service_api_key['key'] = _get_service_user_api_key()
+            _service_api_key['expires'] = time.time() + ttl
+        return _service_api_key['key']
+
+
+def expire_service_api_key():
+    """Forgets the cached service API key, so that it is looked up again
+    the next time it is needed. Used when the key was rejected, e.g.
+    because it was regenerated.
+    """
+    with _service_api_key_lock:
+        _service_api_key['expires'] = 0
+
+
+def _get_service_user_api_key():
+    user_name = config.get('ckanext.ed.service_user')
+    if user_name:
+        user = model.User.get(user_name)
+    else:
+        user = model.Session.query(model.User).filter(
+            model.User.sysadmin == True,
+            model.User.state == 'active').first()
+    return user.apikey if user else None
+
+
 def get_total_views_for_dataset(id):
-    '''Returns totoal number of unique views for the dataset
+    '''Returns totoal number of unique views for the dataset. The views of
+    all the datasets of the search results of the request are read with the
+    first call, see `queue_total_views_for_datasets`.
 
     :param id: dataset id
     :type id: string
@@ -110,16 +256,59 @@ def get_total_views_for_dataset(id):
     :returns: number of unique views
     :rtype: integer
     '''
-    data_dict = {
-        'id': id,
-        'include_tracking': True
-    }
+    total_views = _get_request_cache('total_views')
+    if total_views.get(id) is None:
+        ids = [id_ for id_, total in total_views.items() if total is None]
+        if id not in ids:
+            ids.append(id)
+        total_views.update(_get_total_views(ids))
+    return total_views[id]
 
+
+def queue_total_views_for_datasets(ids):
+    '''Remembers the datasets whose views are going to be shown during the
+    current request, so they are read in one go
+
+    :param ids: dataset ids
+    :type ids: list
+    '''
+    total_views = _get_request_cache('total_views')
+    for id_ in ids:
+        total_views.setdefault(id_, None)
+
+
+def _get_total_views(ids):
+    # The latest tracking summary of a dataset holds its running total, as
+    # in TrackingSummary.get_for_package
+    summary = model.TrackingSummary
+    latest = model.Session.query(
+        summary.package_id, summary.running_total
+    ).filter(
+        summary.package_id.in_(ids)
+    ).distinct(summary.package_id).order_by(
+        summary.package_id, summary.tracking_date.desc())
+
+    total_views = dict.fromkeys(ids, 0)
+    total_views.update(
+        (package_id, running_total or 0)
+        for package_id, running_total in latest)
+    return total_views
+
+
+def _get_request_cache(name):
+    '''Returns a dict that is kept until the end of the current request, or
+    a new one when there is no request, e.g. in background jobs
+    '''
+    attr = '_ed_{0}'.format(name)
     try:
-        dataset = _get_action('package_show', {}, data_dict)
-        return dataset.get('tracking_summary').get('total')
-    except Exception:
-        return 0
+        cache = getattr(c, attr, None)
+        # Missing attributes of the Pylons context are empty strings
+        if not isinstance(cache, dict):
+            cache = {}
+            setattr(c, attr, cache)
+    except (TypeError, RuntimeError):
+        cache = {}
+    return cache
 
 
 def is_admin(user, office=None):
@@ -135,12 +324,82 @@ def is_admin(user, office=None):
     :returns: True/False
     :rtype: boolean
     """
-    user_orgs = _get_action(
-                'organization_list_for_user', {'user': user}, {'user': user})
+    capacities = get_user_capacities(user)
     if office is not None:
-        return any([i.get('capacity') == 'admin' \
-                and i.get('id') == office for i in user_orgs])
-    return any([i.get('capacity') == 'admin' for i in user_orgs])
+        return capacities.get(office) == 'admin'
+    return 'admin' in capacities.values()
+
+
+def get_user_capacities(user):
+    """
+    Returns the capacity of the user in each of their organisations. It is
+    looked up once per request, as every permission check of the workflow
+    reads it, and is kept by the process for
+    `ckanext.ed.user_capacities_ttl` seconds or until memberships change,
+    see `expire_user_capacities`.
+
+    :param user: user name or id
+    :type user: string
+
+    :returns: capacities by organisation id, e.g. {org_id: 'admin'}
+    :rtype: dict
+    """
+    user_obj = model.User.get(user) if user else None
+    if user_obj is None:
+        return {}
+
+    capacities = _get_request_cache('user_capacities')
+    if user_obj.id not in capacities:
+        capacities[user_obj.id] = _get_cached_user_capacities(user_obj)
+    return capacities[user_obj.id]
+
+
+def expire_user_capacities():
+    """
+    Makes every process look the capacities of the users up again. Used
+    when memberships change.
+    """
+    increment_cache_generation(USER_CAPACITIES_GENERATION)
+    with _user_capacities_lock:
+        _user_capacities.clear()
+    _get_request_cache('user_capacities').clear()
+    _get_request_cache('cache_generations').pop(
+        USER_CAPACITIES_GENERATION, None)
+
+
+def _get_cached_user_capacities(user_obj):
+    # The generation is read before the capacities, so capacities looked up
+    # during a membership change are not kept
+    generation = _get_user_capacities_generation()
+    with _user_capacities_lock:
+        cached = _user_capacities.get(user_obj.id)
+    if (cached and cached['generation'] == generation and
+            time.time() < cached['expires']):
+        return cached['capacities']
+
+    # All memberships, not only the organisations the user can manage
+    user_orgs = _get_action(
+        'organization_list_for_user', {'user': user_obj.name},
+        {'permission': 'read'})
+    capacities = dict((i['id'], i.get('capacity')) for i in user_orgs)
+
+    ttl = toolkit.asint(config.get(
+        'ckanext.ed.user_capacities_ttl', DEFAULT_USER_CAPACITIES_TTL))
+    with _user_capacities_lock:
+        _user_capacities[user_obj.id] = {
+            'capacities': capacities,
+            'generation': generation,
+            'expires': time.time() + ttl,
+        }
+    return capacities
+
+
+def _get_user_capacities_generation():
+    generations = _get_request_cache('cache_generations')
+    if USER_CAPACITIES_GENERATION not in generations:
+        generations[USER_CAPACITIES_GENERATION] = get_cache_generation(
+            USER_CAPACITIES_GENERATION)
+    return generations[USER_CAPACITIES_GENERATION]
 
 
 def get_pending_datasets(user, include_rejected=False):
@@ -157,10 +416,10 @@ def get_pending_datasets(user, include_rejected=False):
     :rtype: list
     """
     role = 'editor' if include_rejected else 'admin'
-    user_orgs = _get_action(
-        'organization_list_for_user', {'id': user}, {'id': user})
     user_org_pemrs = [
-        'owner_org:' + i['id'] for i in user_orgs if i.get('capacity') == role
+        'owner_org:' + org_id
+        for org_id, capacity in get_user_capacities(user).items()
+        if capacity == role
     ]
     fq_string = '(approval_state:approval_pending{0}){1}{2}'.format(
         # Include rejected datasets if needed
@@ -196,7 +455,16 @@ def workflow_activity_create(
             'feedback': feedback
         }
     }
-    toolkit.get_action('activity_create')(activity_context, data_dict)
+    activity_dict = toolkit.get_action('activity_create')(
+        activity_context, data_dict)
+
+    # Also recorded where it can be queried without decoding activities
+    WorkflowTransition.from_activity(
+        model.Activity.get(activity_dict['id'])).save()
+
+    # A rejection is no longer relevant once the dataset moves on
+    _cache_latest_rejection_feedback(
+        dataset_id, feedback if activity == 'dataset_rejected' else None)
 
 
 def custom_activity_renderer(context, activity):
@@ -234,7 +502,10 @@ def custom_activity_renderer(context, activity):
 
 
 def get_latest_rejection_feedback(pkg_id):
-    '''Returns the latest rejection feedback for dataset
+    '''Returns the latest rejection feedback for dataset, unless the dataset
+    was approved or resubmitted since. It is cached per dataset and kept up
+    to date by `workflow_activity_create`, and read from the workflow
+    transitions when Redis is unavailable.
 
     :param pkg_id: id of the dataset
     :type pkg_id: string
@@ -242,39 +513,85 @@ def get_latest_rejection_feedback(pkg_id):
     :returns: Rejected feedback
     :rtype: string
     '''
-    context = {'ignore_auth': True}
-    data_dict = {
-        'id': pkg_id,
-        'get_workflow_activities': True
-    }
-
-    activities = toolkit.get_action('package_activity_list')(
-        context, data_dict)
+    try:
+        cached = connect_to_redis().get(
+            _get_latest_rejection_cache_key(pkg_id))
+    except RedisError as e:
+        log.warning('Rejection feedback cache unavailable: %s', e)
+        cached = None
+    if cached is not None:
+        return json.loads(cached)
+
+    transition = WorkflowTransition.latest(pkg_id)
+    feedback = None
+    if transition is not None and transition.transition == 'dataset_rejected':
+        feedback = transition.feedback
+    _cache_latest_rejection_feedback(pkg_id, feedback)
+    return feedback
+
+
+def expire_latest_rejection_feedback():
+    '''Drops the cached rejection feedback of all the datasets, e.g. once
+    workflow transitions were backfilled'''
+    redis_conn = connect_to_redis()
+    pattern = _get_latest_rejection_cache_key('*')
+    keys = []
+    for key in redis_conn.scan_iter(match=pattern, count=1000):
+        keys.append(key)
+        if len(keys) >= 1000:
+            redis_conn.delete(*keys)
+            keys = []
+    if keys:
+        redis_conn.delete(*keys)
+
+
+def _get_latest_rejection_cache_key(pkg_id):
+    return '{0}:ckanext.ed:latest_rejection:{1}'.format(
+        config.get('ckan.site_id'), pkg_id)
+
+
+def _cache_latest_rejection_feedback(pkg_id, feedback):
+    # JSON, so that "no rejection" (null) is cached too. The workflow steps
+    # are already saved, so they don't fail on a cache error
+    key = _get_latest_rejection_cache_key(pkg_id)
+    try:
+        connect_to_redis().set(
+            key, json.dumps(feedback), ex=LATEST_REJECTION_CACHE_TTL)
+    except RedisError as e:
+        log.warning('Rejection feedback cache unavailable: %s', e)
 
-    for activity in activities:
-        if (activity['data']['workflow_activity'] == 'dataset_rejected' and
-                activity['data'].get('feedback')):
-            return activity['data']['feedback']
 
 def quality_mark(package):
-    """Returns flag for quality about dataset
+    """Returns flag for quality about dataset. Datasets from search results
+    have them stored in the search index already.
     :param pacakge: Package dictionary
     :return: dict
          ['machine'] - True if there's at least one machine readable resource.
          ['doc'] - True if there's at least one document resource.
     """
+    if all(field in package for field in QUALITY_MARK_FIELDS.values()):
+        return dict((mark, package[field])
+                    for mark, field in QUALITY_MARK_FIELDS.items())
+    return get_quality_mark(package)
+
+
+def get_quality_mark(package):
+    """Computes the flags returned by `quality_mark` from the resources of
+    the dataset
+    """
+    resources = package.get('resources') or []
     at_least_one_machine_resource = \
-        any([True for r in package['resources'] if r['format']=='CSV' or
-                                            r['format'] == 'XML' or
-                                            r['mimetype'] == 'text/csv' or
-                                            r['mimetype'] == 'text/json' or
-                                            r['mimetype'] == 'application/json' or
-                                            r['url_type']!='upload' and r['url']!=''])
+        any([True for r in resources if r.get('format')=='CSV' or
+                                            r.get('format') == 'XML' or
+                                            r.get('mimetype') == 'text/csv' or
+                                            r.get('mimetype') == 'text/json' or
+                                            r.get('mimetype') == 'application/json' or
+                                            r.get('url_type')!='upload' and r.get('url', '')!=''])
 
 
 
     at_least_one_document_resource = \
-        any([True for r in package['resources'] if r.get('resource_type')=='doc'])
+        any([True for r in resources if r.get('resource_type')=='doc'])
 
     return { 'machine' : at_least_one_machine_resource,
              'doc' : at_least_one_document_resource }
@@ -0,0 +1,184 @@
+import datetime
+
+import sqlalchemy
+from sqlalchemy import Column, Index, MetaData, Table, types
+
+from ckan import model
+from ckan.model import domain_object
+from ckan.model.types import make_uuid
+
+
+WORKFLOW_TRANSITIONS = (
+    'submitted_for_review',
+    'resubmitted_for_review',
+    'dataset_approved',
+    'dataset_rejected',
+)
+
+metadata = MetaData()
+
+workflow_transition_table = Table(
+    'ed_workflow_transition', metadata,
+    Column('id', types.UnicodeText, primary_key=True, default=make_uuid),
+    Column('package_id', types.UnicodeText, nullable=False),
+    Column('actor', types.UnicodeText),
+    Column('transition', types.UnicodeText, nullable=False),
+    Column('feedback', types.UnicodeText),
+    Column('timestamp', types.DateTime, nullable=False,
+           default=datetime.datetime.utcnow),
+    # The activity the transition was recorded with, if any
+    Column('activity_id', types.UnicodeText, unique=True),
+    Index('idx_ed_workflow_transition_package_timestamp',
+          'package_id', 'timestamp'),
+    Index('idx_ed_workflow_transition_transition_timestamp',
+          'transition', 'timestamp'),
+)
+
+# Counters bumped whenever data cached by the web workers changes, so that
+# every worker drops its copy
+cache_generation_table = Table(
+    'ed_cache_generation', metadata,
+    Column('name', types.UnicodeText, primary_key=True),
+    Column('generation', types.Integer, nullable=False, default=0),
+)
+
+
+class WorkflowTransition(domain_object.DomainObject):
+    '''A step of the publishing workflow of a dataset. `transition` is one
+    of WORKFLOW_TRANSITIONS and `actor` the user who made it.
+    '''
+
+    @classmethod
+    def latest(cls, package_id, transition=None):
+        '''Returns the latest transition of the dataset, optionally of the
+        given kind only
+
+        :param package_id: id of the dataset
+        :type package_id: string
+        :param transition: kind of transition (optional)
+        :type transition: string
+
+        :returns: the transition or None
+        :rtype: WorkflowTransition
+        '''
+        q = model.Session.query(cls).filter(cls.package_id == package_id)
+        if transition is not None:
+            q = q.filter(cls.transition == transition)
+        return q.order_by(cls.timestamp.desc()).first()
+
+    @classmethod
+    def since(cls, transition, timestamp):
+        '''Returns the transitions of the given kind made after the timestamp,
+        oldest first
+
+        :param transition: kind of transition
+        :type transition: string
+        :param timestamp: UTC date and time
+        :type timestamp: datetime.datetime
+
+        :returns: the transitions
+        :rtype: list
+        '''
+        return model.Session.query(cls).filter(
+            cls.transition == transition,
+            cls.timestamp > timestamp
+        ).order_by(cls.timestamp).all()
+
+    @classmethod
+    def from_activity(cls, activity):
+        '''Returns the transition recorded by a workflow activity. It is not
+        added to the session.
+
+        :param activity: an activity created by `workflow_activity_create`
+        :type activity: ckan.model.Activity
+        '''
+        return cls(
+            package_id=activity.object_id,
+            actor=activity.user_id,
+            transition=activity.data['workflow_activity'],
+            feedback=activity.data.get('feedback'),
+            timestamp=activity.timestamp,
+            activity_id=activity.id)
+
+
+model.meta.mapper(WorkflowTransition, workflow_transition_table)
+
+
+def setup():
+    '''Creates the tables of the extension if they do not exist yet'''
+    metadata.create_all(model.meta.engine, checkfirst=True)
+
+
+def get_cache_generation(name):
+    '''Returns the current generation of the cached data
+
+    :param name: name of the cached data
+    :type name: string
+
+    :rtype: integer
+    '''
+    return model.Session.execute(
+        sqlalchemy.select([cache_generation_table.c.generation]).where(
+            cache_generation_table.c.name == name)
+    ).scalar() or 0
+
+
+def increment_cache_generation(name):
+    '''Marks the cached data as outdated in every process. The counter is
+    updated in its own transaction, so the caller's session is left alone.
+
+    :param name: name of the cached data
+    :type name: string
+    '''
+    table = cache_generation_table
+    increment = table.update().where(table.c.name == name).values(
+        generation=table.c.generation + 1)
+    with model.meta.engine.begin() as connection:
+        if connection.execute(increment).rowcount:
+            return
+        try:
+            with connection.begin_nested():
+                connection.execute(
+                    table.insert().values(name=name, generation=1))
+        except sqlalchemy.exc.IntegrityError:
+            # Inserted by another process in the meantime
+            connection.execute(increment)
+
+
+def backfill_workflow_transitions(batch_size=1000):
+    '''Records the transitions of the workflow activities created before the
+    workflow transition table existed. Activities that were already recorded
+    are skipped, so it can be run more than once.
+
+    :returns: the number of recorded transitions
+    :rtype: integer
+    '''
+    recorded = model.Session.query(WorkflowTransition.activity_id).filter(
+        WorkflowTransition.activity_id != None)
+    # `data` is JSON stored as text
+    data = sqlalchemy.cast(model.Activity.data, types.UnicodeText)
+    query = model.Session.query(model.Activity).filter(
+        data.like('%"workflow_activity"%'),
+        ~model.Activity.id.in_(recorded)
+    ).order_by(model.Activity.timestamp, model.Activity.id)
+
+    count = 0
+    last = None
+    while True:
+        batch = query
+        if last is not None:
+            last_timestamp, last_id = last
+            batch = batch.filter(sqlalchemy.or_(
+                model.Activity.timestamp > last_timestamp,
+                sqlalchemy.and_(model.Activity.timestamp == last_timestamp,
+                                model.Activity.id > last_id)))
+        activities = batch.limit(batch_size).all()
+        if not activities:
+            break
+        for activity in activities:
+            if activity.data.get('workflow_activity') in WORKFLOW_TRANSITIONS:
+                model.Session.add(WorkflowTransition.from_activity(activity))
+                count += 1
+        last = (activities[-1].timestamp, activities[-1].id)
+        model.Session.commit()
+    return count
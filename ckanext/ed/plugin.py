@@ -1,3 +1,5 @@
+import json
+
 from ckan.lib.activity_streams import activity_stream_string_functions
 from ckan.lib.plugins import DefaultTranslation
 import ckan.plugins as plugins
@@ -5,10 +7,12 @@ import ckan.plugins.toolkit as toolkit
 import routes.mapper
 
 from ckanext.ed import actions, helpers, validators
+from ckanext.ed import model as ed_model
 
 
 class EDPlugin(plugins.SingletonPlugin, DefaultTranslation):
     plugins.implements(plugins.IConfigurer)
+    plugins.implements(plugins.IConfigurable)
     plugins.implements(plugins.ITemplateHelpers)
     plugins.implements(plugins.ITranslation)
     plugins.implements(plugins.IActions)
@@ -47,13 +51,22 @@ class EDPlugin(plugins.SingletonPlugin, DefaultTranslation):
         '''
         return {
             'ed_prepare_zip_resources': actions.prepare_zip_resources,
+            'ed_zip_status': actions.zip_status,
             'package_show': actions.package_show,
             'package_create': actions.package_create,
             'package_update': actions.package_update,
             'package_activity_list': actions.package_activity_list,
             'dashboard_activity_list': actions.dashboard_activity_list,
             'group_activity_list': actions.group_activity_list,
-            'recently_changed_packages_activity_list': actions.recently_changed_packages_activity_list
+            'recently_changed_packages_activity_list': actions.recently_changed_packages_activity_list,
+            'package_activity_list_html': actions.package_activity_list_html,
+            'group_activity_list_html': actions.group_activity_list_html,
+            'dashboard_activity_list_html': actions.dashboard_activity_list_html,
+            'member_create': actions.member_create,
+            'member_delete': actions.member_delete,
+            'organization_member_create': actions.organization_member_create,
+            'organization_member_delete': actions.organization_member_delete,
+            'organization_create': actions.organization_create
         }
 
     # IPackageController
@@ -75,6 +88,64 @@ class EDPlugin(plugins.SingletonPlugin, DefaultTranslation):
         })
         return search_params
 
+    def after_search(self, search_results, search_params):
+        '''
+        Read the views of the listed datasets at once, if they are shown,
+        and label the quality mark facets
+        '''
+        helpers.queue_total_views_for_datasets(
+            [result['id'] for result in search_results['results']
+             if 'id' in result])
+
+        for field in helpers.QUALITY_MARK_FIELDS.values():
+            for item in search_results.get('search_facets', {}).get(
+                    field, {}).get('items', []):
+                item['display_name'] = (
+                    toolkit._('Yes') if item['name'] == 'true'
+                    else toolkit._('No'))
+        return search_results
+
+    def before_index(self, pkg_dict):
+        '''
+        Store the quality marks of the dataset, so that search results
+        don't compute them again and they can be used as facets
+        '''
+        # The validated dict is only indexed with
+        # ckan.cache_validated_datasets enabled
+        validated = 'validated_data_dict' in pkg_dict
+        data_dict = json.loads(
+            pkg_dict['validated_data_dict'] if validated
+            else pkg_dict.get('data_dict') or '{}')
+        quality_mark = helpers.get_quality_mark(data_dict)
+        for mark, field in helpers.QUALITY_MARK_FIELDS.items():
+            pkg_dict[field] = 'true' if quality_mark[mark] else 'false'
+            data_dict[field] = quality_mark[mark]
+        if validated:
+            pkg_dict['validated_data_dict'] = json.dumps(data_dict)
+        return pkg_dict
+
+    def after_create(self, context, pkg_dict):
+        '''
+        Build the archive of the new dataset's resources and refresh the
+        homepage lists
+        '''
+        actions.enqueue_dataset_zip(pkg_dict['id'])
+        helpers.expire_homepage_datasets_on_commit()
+
+    def after_update(self, context, pkg_dict):
+        '''
+        Rebuild the archive of the dataset's resources. Resource changes
+        are saved through package_update, so they end up here too.
+        '''
+        actions.enqueue_dataset_zip(pkg_dict.get('id') or pkg_dict['name'])
+        helpers.expire_homepage_datasets_on_commit()
+
+    def after_delete(self, context, pkg_dict):
+        '''
+        Refresh the homepage lists
+        '''
+        helpers.expire_homepage_datasets_on_commit()
+
     # IConfigurer
     def update_config(self, config_):
         '''
@@ -86,6 +157,15 @@ class EDPlugin(plugins.SingletonPlugin, DefaultTranslation):
 
         activity_stream_string_functions['changed package'] = helpers.custom_activity_renderer
 
+    # IConfigurable
+    def configure(self, config_):
+        '''
+        Create the tables of the extension and queue the dataset archives
+        and refresh the homepage lists once the dataset changes are
+        committed
+        '''
+        ed_model.setup()
+        actions.listen_for_commits()
 
     # IRoutes
     def before_map(self, map):
@@ -111,6 +191,12 @@ class EDPlugin(plugins.SingletonPlugin, DefaultTranslation):
         map.connect('/dataset-publish/{id}/resubmit',
                     controller=publish_controller,
                     action='resubmit')
+        map.connect(
+            'download_zip_stream',
+            '/download/zip-stream',
+            controller='ckanext.ed.controller:DownloadController',
+            action='stream_zip'
+        )
         map.connect(
             'download_zip',
             '/download/zip/{zip_id}',
@@ -269,6 +355,8 @@ class EDPlugin(plugins.SingletonPlugin, DefaultTranslation):
         facets_dict['spatial'] = "Geography"
         facets_dict['license_id'] = "License"
         facets_dict['level_of_data_string'] = "Level Of Data"
+        facets_dict['machine_readable'] = "Machine Readable"
+        facets_dict['has_documentation'] = "Documentation"
         return facets_dict
 
     def organization_facets(self, facets_dict, organization_type, package_type):
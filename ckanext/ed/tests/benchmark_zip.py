@@ -0,0 +1,273 @@
+'''Benchmark of zip archive preparation.
+
+Serves synthetic resources from a local threaded HTTP server, so no real
+datasets or network are involved, and times `prepare_zip_resources` for
+every combination of resource count, size and mimetype. Results are written
+as JSON so they can be compared across releases.
+
+Usage:
+
+    python ckanext/ed/tests/benchmark_zip.py -c test.ini \\
+        --resources 1,10 --sizes 1M,10M --mimetypes text/csv,image/png \\
+        --output benchmark.json
+
+Every case runs in its own process, so the reported peak RSS is not
+inflated by the previous cases.
+'''
+import argparse
+import BaseHTTPServer
+import SocketServer
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import mock
+
+
+CHUNK_SIZE = 64 * 1024
+SIZE_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_size(value):
+    '''Returns the number of bytes for sizes like 512K, 10M or 1G'''
+    value = value.strip().upper()
+    if value[-1] in SIZE_UNITS:
+        return int(float(value[:-1]) * SIZE_UNITS[value[-1]])
+    return int(value)
+
+
+def _synthetic_block(mimetype):
+    # Text compresses like real CSV files, anything else like already
+    # compressed data
+    if mimetype.startswith('text/') or mimetype.endswith(('json', 'xml')):
+        row = b'2019,Springfield Elementary,K-5,512,0.93\n'
+        return row * (CHUNK_SIZE // len(row) + 1)
+    return os.urandom(CHUNK_SIZE)
+
+
+class _ResourceHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Serves /<size>/<mimetype> with `size` bytes of synthetic content'''
+    blocks = {}
+
+    def do_HEAD(self):
+        self._respond(send_body=False)
+
+    def do_GET(self):
+        self._respond(send_body=True)
+
+    def _respond(self, send_body):
+        try:
+            size, mimetype = self.path.lstrip('/').split('/', 1)
+            size = int(size)
+        except ValueError:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', mimetype)
+        self.send_header('Content-Length', str(size))
+        self.end_headers()
+        if not send_body:
+            return
+
+        block = self.blocks.get(mimetype)
+        if block is None:
+            block = self.blocks[mimetype] = _synthetic_block(mimetype)
+        remaining = size
+        while remaining > 0:
+            data = block[:min(remaining, len(block))]
+            self.wfile.write(data)
+            remaining -= len(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _ThreadedHTTPServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def start_server():
+    '''Starts the resource server on a free local port
+
+    :returns: the server and its base URL
+    :rtype: tuple
+    '''
+    server = _ThreadedHTTPServer(('127.0.0.1', 0), _ResourceHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:{0}'.format(server.server_address[1])
+
+
+def _get_resources(base_url, count, size, mimetype):
+    return [{
+        'id': 'benchmark-{0}'.format(i),
+        'package_id': 'benchmark',
+        'name': 'resource-{0}'.format(i),
+        'url': '{0}/{1}/{2}'.format(base_url, size, mimetype),
+        'url_type': '',
+        'format': '',
+        'mimetype': mimetype,
+        'size': size,
+        'last_modified': None,
+        'revision_id': None,
+    } for i in range(count)]
+
+
+def run_case(base_url, count, size, mimetype):
+    '''Prepares an archive of `count` resources of `size` bytes
+
+    :returns: the measurements of the case
+    :rtype: dict
+    '''
+    from ckan.common import config
+    from ckan.plugins import toolkit
+    from ckanext.ed import actions, helpers
+
+    resources = dict(
+        (r['id'], r) for r in _get_resources(base_url, count, size, mimetype))
+
+    def get_action(name):
+        def action(context, data_dict):
+            if name == 'resource_show':
+                return dict(resources[data_dict['id']])
+            if name == 'package_show':
+                return {'id': 'benchmark', 'name': 'benchmark'}
+            raise toolkit.ObjectNotFound()
+        return action
+
+    storage_path = tempfile.mkdtemp()
+    settings = {
+        'ckan.storage_path': storage_path,
+        # Every case has to build its archive
+        'ckanext.ed.zip.cache_enabled': 'false',
+        'ckanext.ed.zip.max_size': '0',
+        'ckanext.ed.zip.max_jobs': '0',
+    }
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    try:
+        with mock.patch.dict(config, settings), \
+                mock.patch.object(toolkit, 'get_action', get_action), \
+                mock.patch.object(helpers, 'get_service_api_key',
+                                  return_value='benchmark'):
+            started = time.time()
+            result = actions.prepare_zip_resources(
+                {}, {'resources': sorted(resources)})
+            wall_time = time.time() - started
+
+            file_name = result['zip_id'].split('::')[0]
+            archive_size = os.path.getsize(os.path.join(
+                helpers.get_storage_path_for('temp-ed'), file_name))
+    finally:
+        shutil.rmtree(storage_path)
+
+    bytes_in = count * size
+    return {
+        'resources': count,
+        'size': size,
+        'mimetype': mimetype,
+        'skipped': len(result['skipped']),
+        'wall_time': round(wall_time, 4),
+        'bytes_in': bytes_in,
+        'archive_size': archive_size,
+        'bytes_per_second': int(bytes_in / wall_time) if wall_time else None,
+        'rss_before_kb': rss_before,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def _run_case_in_process(queue, *args):
+    try:
+        queue.put(run_case(*args))
+    except Exception as e:
+        queue.put({'error': repr(e)})
+
+
+def run_benchmark(counts, sizes, mimetypes):
+    '''Runs every combination of resource count, size and mimetype
+
+    :returns: the results, ready to be dumped as JSON
+    :rtype: dict
+    '''
+    from ckan.common import config
+    from ckanext.ed import archive
+
+    server, base_url = start_server()
+    results = []
+    try:
+        for count in counts:
+            for size in sizes:
+                for mimetype in mimetypes:
+                    queue = multiprocessing.Queue()
+                    process = multiprocessing.Process(
+                        target=_run_case_in_process,
+                        args=(queue, base_url, count, size, mimetype))
+                    process.start()
+                    case = queue.get()
+                    process.join()
+                    case.setdefault('resources', count)
+                    case.setdefault('size', size)
+                    case.setdefault('mimetype', mimetype)
+                    results.append(case)
+    finally:
+        server.shutdown()
+
+    return {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': {
+            'chunk_size': archive.get_chunk_size(),
+            'fetch_workers': archive.get_fetch_workers(),
+            'compress_level': archive.get_compress_level(),
+            'offload': config.get('ckanext.ed.zip.offload'),
+        },
+        'results': results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark of zip archive preparation')
+    parser.add_argument(
+        '-c', '--config', required=True, help='CKAN ini file')
+    parser.add_argument(
+        '--resources', default='1,10',
+        help='comma separated numbers of resources per archive')
+    parser.add_argument(
+        '--sizes', default='1M,10M',
+        help='comma separated resource sizes, e.g. 512K,10M')
+    parser.add_argument(
+        '--mimetypes', default='text/csv,image/png',
+        help='comma separated resource mimetypes')
+    parser.add_argument(
+        '--output', help='file to write the JSON results to (stdout if not '
+                         'given)')
+    args = parser.parse_args(argv)
+
+    from ckan.lib.cli import load_config
+    load_config(os.path.abspath(args.config))
+
+    results = run_benchmark(
+        [int(c) for c in args.resources.split(',')],
+        [parse_size(s) for s in args.sizes.split(',')],
+        args.mimetypes.split(','))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
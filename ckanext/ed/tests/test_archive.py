@@ -0,0 +1,707 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+
+from ckan import model
+from ckan.plugins import toolkit
+from ckan.tests import helpers as test_helpers
+import mock
+import nose.tools
+
+from ckanext.ed import actions, archive
+
+assert_equals = nose.tools.assert_equals
+assert_not_equals = nose.tools.assert_not_equals
+
+
+class _NonSeekableFile(object):
+    def __init__(self):
+        self.buffer = io.BytesIO()
+
+    def write(self, data):
+        self.buffer.write(data)
+
+
+class TestZipStreamWriter(object):
+
+    def _read(self, data):
+        zip = zipfile.ZipFile(io.BytesIO(data))
+        assert zip.testzip() is None
+        return zip
+
+    def test_entries_are_written_from_chunks(self):
+        out = io.BytesIO()
+        with archive.ZipStreamWriter(out) as writer:
+            writer.write_iter('data.csv', [b'a,b\n', b'', b'1,2\n'], size=8)
+            writer.write_iter('data.json', iter([b'{}']))
+
+        zip = self._read(out.getvalue())
+        assert_equals(zip.namelist(), ['data.csv', 'data.json'])
+        assert_equals(zip.read('data.csv'), b'a,b\n1,2\n')
+        assert_equals(zip.read('data.json'), b'{}')
+
+    def test_deflated_entries(self):
+        out = io.BytesIO()
+        content = b'x' * 100000
+        with archive.ZipStreamWriter(out, zipfile.ZIP_DEFLATED) as writer:
+            zinfo = writer.write_iter('data.txt', [content[:50000], content[50000:]])
+
+        assert zinfo.compress_size < zinfo.file_size
+        assert_equals(self._read(out.getvalue()).read('data.txt'), content)
+
+    def test_writes_to_non_seekable_streams(self):
+        out = _NonSeekableFile()
+        with archive.ZipStreamWriter(out) as writer:
+            writer.write_iter(u'données.csv', [b'1,2'], size=3)
+            writer.write_iter('other.csv', [b'3,4'])
+
+        zip = self._read(out.buffer.getvalue())
+        assert_equals(zip.read(u'données.csv'), b'1,2')
+        assert_equals(zip.read('other.csv'), b'3,4')
+
+    def test_zip64_headers_for_entries_of_unknown_size(self):
+        out = io.BytesIO()
+        with archive.ZipStreamWriter(out) as writer:
+            small = writer.write_iter('small.csv', [b'1,2'], size=3)
+            unknown = writer.write_iter('unknown.csv', [b'3,4'])
+
+        assert_equals(small.extract_version, 20)
+        assert_equals(unknown.extract_version, 45)
+        assert_equals(self._read(out.getvalue()).read('unknown.csv'), b'3,4')
+
+    def test_checksum_of_the_output(self):
+        import hashlib
+
+        out = _NonSeekableFile()
+        digest = hashlib.sha1()
+        with archive.ZipStreamWriter(out) as writer:
+            writer.write_iter('data.csv', archive.iter_hashed([b'1,2'], digest))
+
+        assert_equals(digest.hexdigest(), hashlib.sha1(b'1,2').hexdigest())
+        assert_equals(writer.checksum,
+                      hashlib.sha256(out.buffer.getvalue()).hexdigest())
+
+    def test_precompressed_entries(self):
+        content = b'a,b\n1,2\n' * 10000
+        body, crc, file_size, compress_size = archive.deflate(
+            [content[:1000], content[1000:]], 6, 1024)
+        out = io.BytesIO()
+        with body, archive.ZipStreamWriter(out) as writer:
+            writer.write_iter('stored.png', [b'png'])
+            zinfo = writer.write_compressed(
+                'data.csv', archive.iter_file(body, 1024), crc, file_size,
+                compress_size)
+
+        assert_equals(zinfo.file_size, len(content))
+        assert zinfo.compress_size < zinfo.file_size
+        zip = self._read(out.getvalue())
+        assert_equals(zip.getinfo('stored.png').compress_type,
+                      zipfile.ZIP_STORED)
+        assert_equals(zip.read('data.csv'), content)
+
+
+class TestFetchHelpers(object):
+
+    def test_imap_ordered_keeps_the_order_of_items(self):
+        import time
+
+        def slow_double(i):
+            time.sleep(0.01 * (5 - i))
+            return i * 2
+
+        result = list(archive.imap_ordered(slow_double, range(5), 3))
+        assert_equals(result, [0, 2, 4, 6, 8])
+
+    def test_imap_ordered_reraises_errors(self):
+        def fail(i):
+            raise ValueError(i)
+
+        nose.tools.assert_raises(
+            ValueError, list, archive.imap_ordered(fail, range(3), 2))
+
+    def test_spool(self):
+        body, size = archive.spool(iter([b'abc', b'def']), 4)
+        with body:
+            assert_equals(size, 6)
+            assert_equals(list(archive.iter_file(body, 4)), [b'abcd', b'ef'])
+
+
+    @mock.patch.object(actions.helpers, 'expire_homepage_datasets')
+    def test_homepage_datasets_are_expired_once_committed(self, expire):
+        actions.helpers.expire_homepage_datasets_on_commit()
+        assert not expire.called
+
+        model.Session.commit()
+        assert_equals(expire.call_count, 1)
+
+        actions.helpers.expire_homepage_datasets_on_commit()
+        model.Session.rollback()
+        model.Session.commit()
+        assert_equals(expire.call_count, 1)
+
+class TestZipEntries(object):
+
+    def _resource(self, url):
+        return {'id': 'resource-id', 'name': 'data.csv', 'url': url,
+                'url_type': '', 'format': 'CSV', 'mimetype': 'text/csv',
+                'size': None}
+
+    @test_helpers.change_config('ckan.site_url', 'http://data.example.com')
+    @mock.patch.object(actions.helpers, 'get_service_api_key',
+                       return_value='service-key')
+    def test_api_key_is_only_sent_to_own_site(self, get_service_api_key):
+        own, foreign = actions._get_zip_entries([
+            self._resource('http://data.example.com/dataset/data.csv'),
+            self._resource('http://data.example.com.evil.org/data.csv')])
+        assert_equals(own['headers'], {'Authorization': 'service-key'})
+        assert_equals(foreign['headers'], {})
+
+    @test_helpers.change_config('ckan.site_url', 'http://data.example.com')
+    @mock.patch.object(actions.helpers, 'expire_service_api_key')
+    def test_foreign_auth_errors_keep_the_api_key(self, expire):
+        session = mock.Mock()
+        session.get.return_value.status_code = 401
+        entry = {'id': 'resource-id', 'name': 'data.csv', 'headers': {},
+                 'url': 'http://example.org/data.csv',
+                 'content_type': 'text/csv', 'skipped': None}
+
+        opened = actions._open_resource(session, entry, 1024)
+        assert_equals(opened['skipped'], 'fetch_failed')
+        assert not expire.called
+
+        entry['url'] = 'http://data.example.com/dataset/data.csv'
+        actions._open_resource(session, entry, 1024)
+        assert expire.called
+
+
+class TestDatasetZipPrecompute(object):
+
+    @classmethod
+    def setup_class(cls):
+        actions.listen_for_commits()
+
+    def teardown(self):
+        model.Session.rollback()
+
+    @test_helpers.change_config('ckanext.ed.zip.precompute', True)
+    @mock.patch.object(archive, 'is_cache_enabled', return_value=True)
+    @mock.patch.object(actions.toolkit, 'enqueue_job')
+    def test_jobs_are_queued_once_committed(self, enqueue_job, _):
+        actions.enqueue_dataset_zip('package-id')
+        assert not enqueue_job.called
+
+        model.Session.commit()
+        assert_equals(enqueue_job.call_args[0][1], ['package-id'])
+
+        model.Session.commit()
+        assert_equals(enqueue_job.call_count, 1)
+
+    @test_helpers.change_config('ckanext.ed.zip.precompute', True)
+    @mock.patch.object(archive, 'is_cache_enabled', return_value=True)
+    @mock.patch.object(actions.toolkit, 'enqueue_job')
+    def test_jobs_are_dropped_on_rollback(self, enqueue_job, _):
+        actions.enqueue_dataset_zip('package-id')
+        model.Session.rollback()
+        model.Session.commit()
+        assert not enqueue_job.called
+
+class TestUnsupportedResources(object):
+
+    def setup(self):
+        self.storage_path = tempfile.mkdtemp()
+        self.patchers = [
+            mock.patch.object(archive, 'get_storage_path_for',
+                              return_value=self.storage_path),
+            mock.patch.object(actions.helpers, 'get_storage_path_for',
+                              return_value=self.storage_path)]
+        for patcher in self.patchers:
+            patcher.start()
+
+    def teardown(self):
+        for patcher in self.patchers:
+            patcher.stop()
+        shutil.rmtree(self.storage_path)
+
+    def _resource(self, id, mimetype=None, format=''):
+        return {'id': id, 'package_id': 'package-id', 'name': id,
+                'url': 'http://example.org/' + id, 'url_type': '',
+                'format': format, 'mimetype': mimetype, 'size': None}
+
+    def _response(self, content_type, body=b''):
+        response = mock.Mock(status_code=200)
+        response.headers = {'Content-Type': content_type}
+        response.iter_content.return_value = iter([body])
+        return response
+
+    def test_content_type_is_guessed_from_metadata(self):
+        assert_equals(actions._guess_content_type(
+            {'mimetype': 'Text/CSV; charset=utf-8'}), 'text/csv')
+        assert_equals(actions._guess_content_type({'format': 'JSON'}),
+                      'application/json')
+        assert_equals(actions._guess_content_type({'format': ''}), None)
+
+    def test_unsupported_mimetypes_are_skipped_from_metadata(self):
+        video, unknown = actions._get_zip_entries([
+            self._resource('video', format='MP4'),
+            self._resource('unknown')])
+        assert_equals(video['skipped'], 'unsupported_mimetype')
+        assert_equals(unknown['skipped'], None)
+
+        session = mock.Mock()
+        opened = actions._open_resource(session, video, 1024)
+        assert_equals(opened['skipped'], 'unsupported_mimetype')
+        assert not session.get.called
+
+    def test_unsupported_content_types_are_closed_before_the_body(self):
+        entry, = actions._get_zip_entries([self._resource('page')])
+        session = mock.Mock()
+        session.get.return_value = self._response('text/html; charset=utf-8')
+
+        opened = actions._open_resource(session, entry, 1024)
+
+        assert_equals(opened['skipped'], 'unsupported_mimetype')
+        assert_equals(session.get.call_args[1]['stream'], True)
+        assert session.get.return_value.close.called
+        assert not session.get.return_value.iter_content.called
+
+    @mock.patch.object(archive, 'get_http_session')
+    @mock.patch.object(actions, '_show_resources')
+    def test_skipped_resources_are_reported(self, _show_resources,
+                                            get_http_session):
+        _show_resources.return_value = [
+            self._resource('data', format='CSV'),
+            self._resource('video', format='MP4'),
+            self._resource('page')]
+        responses = {
+            'http://example.org/data': self._response('text/csv', b'a,b\n'),
+            'http://example.org/page': self._response('text/html')}
+        session = get_http_session.return_value
+        session.get.side_effect = lambda url, **kwargs: responses[url]
+
+        result = actions.prepare_zip_resources(
+            {'user': 'u1'}, {'resources': ['data', 'video', 'page']})
+
+        assert_equals(result['skipped'], [
+            {'id': 'video', 'name': 'video.mp4',
+             'reason': 'unsupported_mimetype'},
+            {'id': 'page', 'name': 'page',
+             'reason': 'unsupported_mimetype'}])
+        file_name = result['zip_id'].split('::')[0]
+        zip = zipfile.ZipFile(os.path.join(self.storage_path, file_name))
+        assert_equals(zip.namelist(), ['data.csv'])
+
+class TestUploadedResources(object):
+
+    def setup(self):
+        self.storage_path = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.storage_path, 'resource-id')
+        with open(self.file_path, 'wb') as f:
+            f.write(b'a,b\n1,2\n')
+
+    def teardown(self):
+        shutil.rmtree(self.storage_path)
+
+    def _resource(self):
+        return {'id': 'resource-id', 'name': 'Data', 'url_type': 'upload',
+                'url': 'http://data.example.com/dataset/d/resource/'
+                       'resource-id/download/data.csv',
+                'format': 'CSV', 'mimetype': None, 'size': None}
+
+    def _uploader(self, path):
+        upload = mock.Mock(spec=['get_path'])
+        upload.get_path.return_value = path
+        return upload
+
+    @mock.patch.object(actions.uploader, 'get_resource_uploader')
+    def test_uploads_are_read_from_the_storage(self, get_resource_uploader):
+        get_resource_uploader.return_value = self._uploader(self.file_path)
+        session = mock.Mock()
+
+        entry, = actions._get_zip_entries([self._resource()])
+        opened = actions._open_resource(session, entry, 4)
+        try:
+            assert_equals(b''.join(opened['chunks']), b'a,b\n1,2\n')
+        finally:
+            opened['close']()
+
+        assert_equals(entry['path'], self.file_path)
+        assert_equals(entry['name'], 'data.csv')
+        assert_equals(opened['content_type'], 'text/csv')
+        assert_equals(opened['size'], 8)
+        assert not session.get.called
+
+    @test_helpers.change_config('ckan.site_url', 'http://data.example.com')
+    @mock.patch.object(actions.helpers, 'get_service_api_key',
+                       return_value='service-key')
+    @mock.patch.object(actions.uploader, 'get_resource_uploader')
+    def test_uploads_fall_back_to_http(self, get_resource_uploader, _):
+        # Uploaders storing the files elsewhere, e.g. cloud storage
+        get_resource_uploader.return_value = object()
+        assert_equals(actions._get_upload_path(self._resource()), None)
+
+        # Files missing from the storage
+        get_resource_uploader.return_value = self._uploader(
+            os.path.join(self.storage_path, 'missing'))
+        assert_equals(actions._get_upload_path(self._resource()), None)
+
+        entry, = actions._get_zip_entries([self._resource()])
+        assert 'path' not in entry
+        assert_equals(entry['headers'], {'Authorization': 'service-key'})
+
+        session = mock.Mock()
+        session.get.return_value.status_code = 200
+        session.get.return_value.headers = {}
+        actions._open_resource(session, entry, 4)
+        assert_equals(session.get.call_args[0][0], self._resource()['url'])
+
+    def test_links_are_not_read_from_the_storage(self):
+        resource = dict(self._resource(), url_type='')
+        assert_equals(actions._get_upload_path(resource), None)
+
+class TestJobStatus(object):
+
+    def setup(self):
+        self.storage_path = tempfile.mkdtemp()
+        self.patcher = mock.patch.object(
+            archive, 'get_storage_path_for', return_value=self.storage_path)
+        self.patcher.start()
+
+    def teardown(self):
+        self.patcher.stop()
+        shutil.rmtree(self.storage_path)
+
+    def test_status_roundtrip(self):
+        job_id = 'a' * 32
+        archive.write_status(job_id, {'state': 'queued'})
+        assert_equals(archive.read_status(job_id), {'state': 'queued'})
+
+        archive.write_status(job_id, {'state': 'finished'})
+        assert_equals(archive.read_status(job_id), {'state': 'finished'})
+
+        archive.remove_status(job_id)
+        assert_equals(archive.read_status(job_id), None)
+
+    def test_invalid_job_ids_are_not_found(self):
+        assert_equals(archive.read_status('../../etc/passwd'), None)
+        assert_equals(archive.read_status(None), None)
+
+    @test_helpers.change_config('ckanext.ed.zip.max_jobs', 2)
+    @test_helpers.change_config('ckanext.ed.zip.max_jobs_per_user', 1)
+    def test_admission_limits(self):
+        assert_equals(archive.admit_job('a' * 32, {'state': 'queued'}, 'u1'),
+                      None)
+        assert_equals(archive.read_status('a' * 32),
+                      {'state': 'queued', 'user': 'u1'})
+
+        assert_equals(archive.admit_job('b' * 32, {'state': 'queued'}, 'u1'),
+                      'max_jobs_per_user')
+        assert_equals(archive.admit_job('b' * 32, {'state': 'running'}, 'u2'),
+                      None)
+        assert_equals(archive.admit_job('c' * 32, {'state': 'queued'}, 'u3'),
+                      'max_jobs')
+        assert_equals(archive.read_status('c' * 32), None)
+
+        archive.write_status('a' * 32, {'state': 'finished', 'user': 'u1'})
+        assert_equals(archive.admit_job('c' * 32, {'state': 'queued'}, 'u1'),
+                      None)
+
+    @test_helpers.change_config('ckanext.ed.zip.max_jobs', 1)
+    @test_helpers.change_config('ckanext.ed.zip.job_timeout', 60)
+    def test_dead_jobs_are_not_counted(self):
+        archive.write_status('a' * 32, {'state': 'running'})
+        dead_at = time.time() - 120
+        os.utime(os.path.join(self.storage_path, 'a' * 32 + '.json'),
+                 (dead_at, dead_at))
+
+        assert_equals(archive.admit_job('b' * 32, {'state': 'queued'}), None)
+
+
+    @test_helpers.change_config('ckanext.ed.zip.max_jobs', 1)
+    @mock.patch.object(actions, '_get_zip_entries', return_value=[])
+    def test_streamed_archives_are_admitted(self, _get_zip_entries):
+        stream = actions.stream_zip_resources([{'id': 'resource-id'}], 'u1')
+        nose.tools.assert_raises(
+            toolkit.ValidationError,
+            actions.stream_zip_resources, [{'id': 'resource-id'}], 'u2')
+
+        list(stream)
+        stream.close()
+        assert_equals(archive._get_jobs_in_progress(archive._list_storage()),
+                      {})
+
+    @test_helpers.change_config('ckanext.ed.zip.max_jobs_per_user', 1)
+    @mock.patch.object(actions, '_get_zip_entries', return_value=[])
+    def test_unread_streams_release_their_admission(self, _get_zip_entries):
+        # e.g. HEAD requests, which never read the body
+        stream = actions.stream_zip_resources([{'id': 'resource-id'}], 'u1')
+        stream.close()
+
+        stream = actions.stream_zip_resources([{'id': 'resource-id'}], 'u1')
+        stream.close()
+        assert_equals(archive._get_jobs_in_progress(archive._list_storage()),
+                      {})
+
+    @test_helpers.change_config('ckanext.ed.zip.max_jobs_per_user', 1)
+    @mock.patch.object(actions, '_get_zip_entries', return_value=[])
+    def test_anonymous_streams_are_counted_per_address(self, _):
+        def stream_from(environ):
+            request = mock.Mock(environ=environ)
+            with mock.patch.object(actions, 'request', request):
+                return actions.stream_zip_resources([{'id': 'resource-id'}])
+
+        stream_from({'REMOTE_ADDR': '10.0.0.1'})
+        nose.tools.assert_raises(
+            toolkit.ValidationError, stream_from, {'REMOTE_ADDR': '10.0.0.1'})
+        stream_from({'REMOTE_ADDR': '10.0.0.2'})
+        # Behind a reverse proxy
+        stream_from({'REMOTE_ADDR': '10.0.0.1',
+                     'HTTP_X_FORWARDED_FOR': '1.2.3.4, 192.0.2.1'})
+        nose.tools.assert_raises(
+            toolkit.ValidationError, stream_from,
+            {'REMOTE_ADDR': '10.0.0.1', 'HTTP_X_FORWARDED_FOR': '192.0.2.1'})
+
+    @mock.patch.object(actions, '_build_zip_archive')
+    @mock.patch.object(actions.toolkit, 'get_action')
+    def test_dataset_archives_match_the_dataset_page(
+            self, get_action, _build_zip_archive):
+        package = {'state': 'active', 'resources': [
+            {'id': 'data', 'resource_type': None},
+            {'id': 'doc', 'resource_type': 'doc'}]}
+        get_action.return_value = lambda context, data_dict: (
+            package if 'id' in data_dict else {'name': 'site-user'})
+
+        def build(job_id, resources, user=None, progress=None):
+            # Counted as in progress while the archive is written
+            assert_equals(
+                archive._get_jobs_in_progress(archive._list_storage()).keys(),
+                [job_id])
+        _build_zip_archive.side_effect = build
+
+        actions.prepare_dataset_zip_job('package-id')
+
+        resources = _build_zip_archive.call_args[0][1]
+        assert_equals([resource['id'] for resource in resources], ['data'])
+        assert_equals(
+            archive._get_jobs_in_progress(archive._list_storage()), {})
+
+class TestZipSize(object):
+
+    def _entry(self, size):
+        return {'id': 'resource-id', 'name': 'data.csv', 'headers': {},
+                'url': 'http://example.org/data.csv', 'size': size,
+                'content_type': 'text/csv', 'skipped': None}
+
+    @test_helpers.change_config('ckanext.ed.zip.max_size', 10)
+    @mock.patch.object(archive, 'get_http_session')
+    def test_size_is_checked_from_metadata_only(self, get_http_session):
+        actions._check_zip_size([self._entry(None), self._entry(10)])
+        nose.tools.assert_raises(
+            toolkit.ValidationError, actions._check_zip_size,
+            [self._entry(6), self._entry(5)])
+        assert not get_http_session.called
+
+class TestArchiveCache(object):
+
+    def setup(self):
+        self.storage_path = tempfile.mkdtemp()
+        self.patcher = mock.patch.object(
+            archive, 'get_storage_path_for', return_value=self.storage_path)
+        self.patcher.start()
+
+    def teardown(self):
+        self.patcher.stop()
+        shutil.rmtree(self.storage_path)
+
+    def _archive(self, name, size=10, age=0, used=None):
+        file_path = os.path.join(self.storage_path, name)
+        with open(file_path, 'wb') as f:
+            f.write(b'x' * size)
+        created_at = time.time() - age
+        used_at = created_at if used is None else time.time() - used
+        os.utime(file_path, (used_at, created_at))
+        return file_path
+
+    def test_cache_key_depends_on_resource_versions(self):
+        resources = [
+            {'id': 'b', 'last_modified': '2019-01-01', 'revision_id': '1'},
+            {'id': 'a', 'last_modified': None, 'revision_id': '2'},
+        ]
+        key = archive.get_cache_key(resources)
+
+        assert_equals(archive.get_cache_key(list(reversed(resources))), key)
+        resources[1]['revision_id'] = '3'
+        assert_not_equals(archive.get_cache_key(resources), key)
+
+    def test_cached_archives_keep_their_checksum(self):
+        file_path = self._archive(archive.get_archive_name('a' * 32, 'abc'))
+
+        file_name = archive.store_in_cache(file_path, 'key')
+
+        assert_equals(file_name, 'cache-key.abc.zip')
+        assert_equals(archive.get_archive_checksum(file_name), 'abc')
+        assert_equals(archive.get_cached_archive('key'), file_name)
+        assert_equals(archive.get_archive_checksum('cache-key.zip'), None)
+        assert_not_equals(archive.get_cache_key([], manifest=True),
+                          archive.get_cache_key([]))
+
+    def test_archives_are_reused(self):
+        file_path = self._archive('tmp.zip')
+        assert_equals(archive.get_cached_archive('key'), None)
+
+        file_name = archive.store_in_cache(file_path, 'key')
+
+        assert_equals(file_name, 'cache-key.zip')
+        assert_equals(archive.get_cached_archive('key'), file_name)
+        assert not os.path.exists(file_path)
+
+    @test_helpers.change_config('ckanext.ed.zip.cache_max_age', 60)
+    def test_evicts_archives_created_long_ago(self):
+        self._archive('cache-old.zip', age=120, used=0)
+        self._archive('cache-new.zip', age=30)
+        self._archive('pending.zip', age=120)
+
+        archive.evict_cache()
+
+        assert_equals(
+            sorted(os.listdir(self.storage_path)),
+            ['cache-new.zip', 'pending.zip'])
+
+    @test_helpers.change_config('ckanext.ed.zip.cache_max_age', 60)
+    def test_old_archives_are_not_reused(self):
+        self._archive('cache-key.zip', age=120, used=0)
+
+        assert_equals(archive.get_cached_archive('key'), None)
+
+    @test_helpers.change_config('ckanext.ed.zip.cache_max_size', 25)
+    def test_evicts_least_recently_used_archives_over_max_size(self):
+        self._archive('cache-1.zip', age=10, used=30)
+        self._archive('cache-2.zip', age=30, used=20)
+        self._archive('cache-3.zip', age=20, used=10)
+
+        archive.evict_cache()
+
+        assert_equals(
+            sorted(os.listdir(self.storage_path)),
+            ['cache-2.zip', 'cache-3.zip'])
+
+    def test_reuse_keeps_the_creation_time(self):
+        file_path = self._archive('cache-key.zip', age=30)
+
+        archive.get_cached_archive('key')
+
+        stat = os.stat(file_path)
+        assert stat.st_atime > stat.st_mtime + 20
+
+
+class TestFileIter(object):
+
+    def test_iterates_in_chunks(self):
+        file_iter = archive.FileIter(io.BytesIO(b'abcdefg'), 3)
+        assert_equals(list(file_iter), [b'abc', b'def', b'g'])
+
+    def test_app_iter_range(self):
+        file_iter = archive.FileIter(io.BytesIO(b'abcdefg'), 3)
+        assert_equals(list(file_iter.app_iter_range(2, 7)), [b'cde', b'fg'])
+        assert_equals(list(file_iter.app_iter_range(5, None)), [b'fg'])
+
+    def test_close_closes_the_file(self):
+        f = io.BytesIO(b'abc')
+        archive.FileIter(f).app_iter_range(0, 1).close()
+        assert f.closed
+
+
+class TestOffloadHeader(object):
+
+    def test_disabled_by_default(self):
+        assert_equals(archive.get_offload_header('a.zip'), None)
+
+    @test_helpers.change_config('ckanext.ed.zip.offload', 'x-accel-redirect')
+    @test_helpers.change_config('ckanext.ed.zip.offload_location', '/protected/')
+    def test_x_accel_redirect(self):
+        assert_equals(
+            archive.get_offload_header('a.zip'),
+            ('X-Accel-Redirect', '/protected/a.zip'))
+
+
+class TestZipStream(object):
+
+    def test_archive_is_yielded_while_it_is_written(self):
+        def chunks():
+            yield b'a,b\n'
+            yield b'1,2\n'
+
+        stream = archive.iter_zip_stream(iter([
+            ('data.csv', chunks(), None, zipfile.ZIP_DEFLATED),
+            ('data.json', [b'{}'], 2, None),
+        ]))
+
+        parts = list(stream)
+        assert len(parts) > 3
+        zip = zipfile.ZipFile(io.BytesIO(b''.join(parts)))
+        assert_equals(zip.read('data.csv'), b'a,b\n1,2\n')
+        assert_equals(zip.read('data.json'), b'{}')
+
+
+class TestStorageCleanup(TestArchiveCache):
+
+    @test_helpers.change_config('ckanext.ed.zip.ttl', 60)
+    def test_removes_expired_archives(self):
+        job_id = 'a' * 32
+        self._archive(job_id + '.zip', age=120)
+        archive.write_status(job_id, {'state': 'finished'})
+        expired_at = time.time() - 120
+        os.utime(os.path.join(self.storage_path, job_id + '.json'),
+                 (expired_at, expired_at))
+        self._archive('b' * 32 + '.zip', age=30)
+        self._archive('cache-key.zip', age=120)
+
+        archive.cleanup_storage()
+
+        assert_equals(
+            sorted(os.listdir(self.storage_path)),
+            ['b' * 32 + '.zip', 'cache-key.zip'])
+
+    @test_helpers.change_config('ckanext.ed.zip.storage_quota', 45)
+    def test_removes_oldest_files_over_quota(self):
+        running = 'c' * 32
+        self._archive(running + '.zip', age=50)
+        archive.write_status(running, {'state': 'running'})
+        self._archive('cache-key.zip', age=40)
+        self._archive('a' * 32 + '.zip', age=30)
+        self._archive('b' * 32 + '.zip', age=20)
+
+        total_size = archive.cleanup_storage()
+
+        assert_equals(
+            sorted(os.listdir(self.storage_path)),
+            ['b' * 32 + '.zip', running + '.json', running + '.zip'])
+        assert total_size <= archive.get_storage_quota()
+
+    @test_helpers.change_config('ckanext.ed.zip.storage_quota', 0)
+    def test_quota_of_zero_is_unlimited(self):
+        self._archive('a' * 32 + '.zip', age=30)
+        self._archive('b' * 32 + '.zip', age=20)
+
+        archive.cleanup_storage()
+
+        assert_equals(
+            sorted(os.listdir(self.storage_path)),
+            ['a' * 32 + '.zip', 'b' * 32 + '.zip'])
+
+    @test_helpers.change_config('ckanext.ed.zip.storage_quota', 45)
+    @mock.patch.object(actions, '_show_resources')
+    def test_archives_that_would_not_fit_are_refused(self, _show_resources):
+        self._archive('a' * 32 + '.zip', size=30)
+        _show_resources.return_value = [{
+            'id': 'resource-id', 'package_id': 'package-id', 'name': 'data',
+            'url': 'http://example.org/data.csv', 'url_type': '',
+            'format': 'CSV', 'mimetype': 'text/csv', 'size': 20}]
+
+        nose.tools.assert_raises(
+            toolkit.ValidationError, actions.prepare_zip_resources,
+            {'user': 'u1'}, {'resources': ['resource-id']})
+        assert_equals(os.listdir(self.storage_path), ['a' * 32 + '.zip'])
@@ -1,11 +1,14 @@
 from ckan.tests import helpers as test_helpers
 from ckan.tests import factories as core_factories
 
+import datetime
+import json
 import mock
 import ckan
 import __builtin__ as builtins
 
 from ckanext.ed import helpers
+from ckanext.ed.plugin import EDPlugin
 from ckanext.ed.tests import factories
 
 from pyfakefs import fake_filesystem
@@ -34,6 +37,12 @@ def mock_open_if_open_fails(*args, **kwargs):
 class TestHelpers(test_helpers.FunctionalTestBase):
     import cgi
 
+    @classmethod
+    def setup_class(cls):
+        # Tables of the extension are created when the app is loaded
+        test_helpers.reset_db()
+        super(TestHelpers, cls).setup_class()
+
     class FakeFileStorage(cgi.FieldStorage):
         def __init__(self, fp, filename):
             self.file = fp
@@ -72,6 +81,25 @@ class TestHelpers(test_helpers.FunctionalTestBase):
         assert len(result) == 2, 'Epextec 2 but got %s' % len(result)
         assert result[0]['id'] == dataset['id']
 
+    def test_homepage_datasets_are_cached(self):
+        org = core_factories.Organization()
+        factories.Dataset(owner_org=org['id'])
+
+        result = helpers.get_most_popular_datasets()
+        assert_equals(len(result), 1)
+        assert_equals(sorted(result[0].keys()),
+                      ['id', 'name', 'organization', 'title'])
+        assert_equals(result[0]['organization'], {'title': org['title']})
+
+        with mock.patch.object(
+                helpers, '_search_most_popular_datasets') as search:
+            assert_equals(helpers.get_most_popular_datasets(), result)
+            assert not search.called
+
+        # New datasets are listed straight away
+        factories.Dataset(owner_org=org['id'])
+        assert_equals(len(helpers.get_most_popular_datasets()), 2)
+
     def test_get_groups(self):
         group1 = core_factories.Group()
 
@@ -105,6 +133,39 @@ class TestHelpers(test_helpers.FunctionalTestBase):
         result = helpers.is_admin('ringo')
         assert not result, '%s is not False' %  result
 
+    def test_user_capacities_are_looked_up_once_per_request(self):
+        user = core_factories.User()
+        org = core_factories.Organization(
+            users=[{'name': user['name'], 'capacity': 'editor'}])
+
+        request_context = type('Context', (object,), {})()
+        with mock.patch.object(helpers, 'c', request_context), \
+                mock.patch.object(
+                    helpers, '_get_action', wraps=helpers._get_action
+                ) as get_action:
+            assert_equals(helpers.get_user_capacities(user['name']),
+                          {org['id']: 'editor'})
+            assert not helpers.is_admin(user['name'])
+            assert not helpers.is_admin(user['id'], org['id'])
+            assert_equals(get_action.call_count, 1)
+
+    def test_user_capacities_are_kept_until_memberships_change(self):
+        user = core_factories.User()
+        org = core_factories.Organization()
+
+        with mock.patch.object(
+                helpers, '_get_action', wraps=helpers._get_action
+        ) as get_action:
+            # Every call is a request of its own outside of requests
+            assert not helpers.is_admin(user['name'], org['id'])
+            assert not helpers.is_admin(user['name'], org['id'])
+            assert_equals(get_action.call_count, 1)
+
+        test_helpers.call_action(
+            'organization_member_create', id=org['id'],
+            username=user['name'], role='admin')
+        assert helpers.is_admin(user['name'], org['id'])
+
     @test_helpers.change_config('ckan.storage_path', '/doesnt_exist')
     @mock.patch.object(ckan.lib.uploader, 'os', fake_os)
     @mock.patch.object(builtins, 'open', side_effect=mock_open_if_open_fails)
@@ -232,6 +293,84 @@ class TestHelpers(test_helpers.FunctionalTestBase):
             (quality_mark['machine'], quality_mark['doc']), (True, False)
         )
 
+    def test_quality_mark_is_stored_in_search_index(self):
+        dataset = factories.Dataset(resources=[
+            {'url': 'http://example.com/data.csv', 'format': 'CSV'}])
+        result = test_helpers.call_action(
+            'package_search', q='id:' + dataset['id'],
+            **{'facet.field': ['machine_readable', 'has_documentation']})
+
+        package = result['results'][0]
+        assert_equals(
+            (package['machine_readable'], package['has_documentation']),
+            (True, False))
+        assert_equals(helpers.quality_mark(package),
+                      {'machine': True, 'doc': False})
+        assert_equals(
+            [(item['name'], item['display_name']) for item in
+             result['search_facets']['machine_readable']['items']],
+            [('true', 'Yes')])
+
+    def test_quality_mark_is_indexed_without_validated_data_dict(self):
+        # ckan.cache_validated_datasets = false
+        pkg_dict = EDPlugin().before_index({'data_dict': json.dumps({
+            'resources': [
+                {'url': 'http://example.com/data.csv', 'format': 'CSV'}]
+        })})
+        assert_equals(
+            (pkg_dict['machine_readable'], pkg_dict['has_documentation']),
+            ('true', 'false'))
+        assert 'validated_data_dict' not in pkg_dict
+
+    @test_helpers.change_config('ckanext.ed.service_api_key', 'service-key')
+    def test_get_service_api_key_from_config(self):
+        assert_equals(helpers.get_service_api_key(), 'service-key')
+
+    @test_helpers.change_config('ckanext.ed.service_user', 'ed_service')
+    def test_get_service_api_key_is_cached(self):
+        sysadmin = core_factories.Sysadmin(name='ed_service')
+        helpers.expire_service_api_key()
+
+        assert_equals(helpers.get_service_api_key(), sysadmin['apikey'])
+        with mock.patch.object(helpers, '_get_service_user_api_key') as lookup:
+            helpers.get_service_api_key()
+            assert not lookup.called
+
+            helpers.expire_service_api_key()
+            helpers.get_service_api_key()
+            assert lookup.called
+
+    def test_get_total_views_for_dataset(self):
+        dataset = factories.Dataset()
+        other_dataset = factories.Dataset()
+        for day, running_total in ((1, 3), (2, 5)):
+            ckan.model.Session.execute(
+                ckan.model.tracking_summary_table.insert().values(
+                    url='/dataset/' + dataset['name'],
+                    package_id=dataset['id'],
+                    tracking_type='page',
+                    count=2,
+                    running_total=running_total,
+                    recent_views=running_total,
+                    tracking_date=datetime.date(2019, 1, day)))
+        ckan.model.Session.commit()
+
+        assert_equals(helpers.get_total_views_for_dataset(dataset['id']), 5)
+        assert_equals(
+            helpers.get_total_views_for_dataset(other_dataset['id']), 0)
+
+    def test_total_views_of_search_results_are_read_at_once(self):
+        request_context = type('Context', (object,), {})()
+        with mock.patch.object(helpers, 'c', request_context), \
+                mock.patch.object(
+                    helpers, '_get_total_views',
+                    side_effect=lambda ids: dict.fromkeys(ids, 1)
+                ) as get_total_views:
+            helpers.queue_total_views_for_datasets(['a', 'b', 'c'])
+            for id_ in ('a', 'b', 'c'):
+                assert_equals(helpers.get_total_views_for_dataset(id_), 1)
+            assert_equals(get_total_views.call_count, 1)
+
     def test_alphabetize_dict(self):
         tags_list = [
             {'count': 1,
@@ -1,12 +1,19 @@
+import time
+
 from nose.tools import assert_raises, assert_equals
+import mock
+from redis.exceptions import RedisError
 
 from ckan import model
+from ckan.lib.redis import connect_to_redis
 from ckan.lib.search import rebuild
 from ckan.tests import factories as core_factories
 from ckan.tests import helpers as test_helpers
 from ckan.tests.helpers import call_action, FunctionalTestBase
 import ckan.plugins.toolkit as toolkit
 
+from ckanext.ed import actions, helpers
+from ckanext.ed import model as ed_model
 from ckanext.ed.tests import factories
 
 
@@ -17,6 +24,9 @@ class TestWorFlows(FunctionalTestBase):
         self.pkg_2 = 'test-dataset-2'
         test_helpers.reset_db()
         rebuild()
+        ed_model.setup()
+        model.Session.query(ed_model.WorkflowTransition).delete()
+        model.Session.commit()
         core_factories.User(name='george')
         core_factories.User(name='john')
         core_factories.User(name='paul')
@@ -134,6 +144,230 @@ class TestWorFlows(FunctionalTestBase):
         packages = call_action('package_show', context, **{'id': self.pkg_2})
         assert_equals(packages['name'], self.pkg_2)
 
+    def test_package_activity_list_hides_approval_state_changes(self):
+        context = {'user': 'george'}
+        activities = call_action(
+            'package_activity_list', context, id=self.pkg_1)
+
+        call_action('package_patch', context,
+                    id=self.pkg_1, approval_state='approved')
+        assert_equals(len(call_action(
+            'package_activity_list', context, id=self.pkg_1)),
+            len(activities))
+
+        call_action('package_patch', context,
+                    id=self.pkg_1, title='Changed title')
+        assert_equals(len(call_action(
+            'package_activity_list', context, id=self.pkg_1)),
+            len(activities) + 1)
+
+    def test_approval_state_activities_with_several_details(self):
+        package_id = self.package_approved['id']
+        user_id = model.User.by_name('george').id
+        package = {'package': {'id': package_id}}
+        approval_state = {'package_extra': {'key': 'approval_state'}}
+        other_extra = {'package_extra': {'key': 'spatial'}}
+
+        def create_activity(*details):
+            activity = model.Activity(
+                user_id, package_id, None, 'changed package', {})
+            model.Session.add(activity)
+            model.Session.flush()
+            for object_type, activity_type, data in details:
+                model.Session.add(model.ActivityDetail(
+                    activity.id, package_id, object_type, activity_type,
+                    data))
+            return activity.id
+
+        approval = create_activity(
+            ('PackageExtra', 'changed', approval_state),
+            ('Package', 'changed', package))
+        approval_last = create_activity(
+            ('Package', 'changed', package),
+            ('PackageExtra', 'changed', approval_state))
+        creation = create_activity(
+            ('Package', 'new', package),
+            ('PackageExtra', 'new', approval_state))
+        edit = create_activity(
+            ('Package', 'changed', package),
+            ('PackageExtra', 'changed', other_extra))
+        model.Session.commit()
+
+        assert_equals(
+            actions._get_approval_state_activity_ids(
+                {'model': model}, [approval, approval_last, creation, edit]),
+            set([approval, approval_last]))
+
+    def test_package_activity_list_offset_pages_do_not_overlap(self):
+        context = {'user': 'george'}
+        call_action('package_patch', context,
+                    id=self.pkg_1, title='Changed title')
+        call_action('package_patch', context,
+                    id=self.pkg_1, approval_state='approved')
+        call_action('package_patch', context,
+                    id=self.pkg_1, title='Changed title again')
+
+        activity_ids = []
+        for offset in range(10):
+            activity_ids.extend(a['id'] for a in call_action(
+                'package_activity_list', context,
+                id=self.pkg_1, limit=1, offset=offset))
+        assert_equals(len(activity_ids), len(set(activity_ids)))
+        assert_equals(activity_ids, [a['id'] for a in call_action(
+            'package_activity_list', context, id=self.pkg_1)])
+
+    def test_activity_pages_are_full_despite_workflow_activities(self):
+        context = {'user': 'george'}
+        for activity in ('submitted_for_review', 'dataset_rejected',
+                         'resubmitted_for_review'):
+            helpers.workflow_activity_create(
+                activity, self.package_approved['id'], self.pkg_1, 'george')
+
+        activities = call_action(
+            'package_activity_list', context, id=self.pkg_1, limit=1)
+        assert_equals(len(activities), 1)
+        assert 'workflow_activity' not in activities[0]['data']
+
+        workflow_activities = call_action(
+            'package_activity_list', context, id=self.pkg_1, limit=2,
+            get_workflow_activities=True)
+        assert_equals(
+            [a['data']['workflow_activity'] for a in workflow_activities],
+            ['resubmitted_for_review', 'dataset_rejected'])
+
+    def test_workflow_transitions_are_recorded(self):
+        helpers.workflow_activity_create(
+            'submitted_for_review', self.package_approved['id'], self.pkg_1,
+            'john')
+        helpers.workflow_activity_create(
+            'dataset_rejected', self.package_approved['id'], self.pkg_1,
+            'george', feedback='Missing data dictionary')
+
+        latest = ed_model.WorkflowTransition.latest(
+            self.package_approved['id'])
+        assert_equals(latest.transition, 'dataset_rejected')
+        assert_equals(latest.feedback, 'Missing data dictionary')
+
+        submitted = ed_model.WorkflowTransition.latest(
+            self.package_approved['id'], 'submitted_for_review')
+        assert submitted.timestamp <= latest.timestamp
+
+    def test_get_latest_rejection_feedback(self):
+        pkg_id = self.package_approved['id']
+        assert_equals(helpers.get_latest_rejection_feedback(pkg_id), None)
+
+        helpers.workflow_activity_create(
+            'dataset_rejected', pkg_id, self.pkg_1, 'george',
+            feedback='Missing data dictionary')
+        assert_equals(helpers.get_latest_rejection_feedback(pkg_id),
+                      'Missing data dictionary')
+
+        # Cold cache
+        connect_to_redis().delete(
+            helpers._get_latest_rejection_cache_key(pkg_id))
+        assert_equals(helpers.get_latest_rejection_feedback(pkg_id),
+                      'Missing data dictionary')
+
+        helpers.workflow_activity_create(
+            'resubmitted_for_review', pkg_id, self.pkg_1, 'john')
+        assert_equals(helpers.get_latest_rejection_feedback(pkg_id), None)
+
+    def test_get_latest_rejection_feedback_without_redis(self):
+        pkg_id = self.package_approved['id']
+        redis_conn = mock.Mock()
+        redis_conn.get.side_effect = RedisError('Connection refused')
+        redis_conn.set.side_effect = RedisError('Connection refused')
+        with mock.patch('ckanext.ed.helpers.connect_to_redis',
+                        return_value=redis_conn):
+            helpers.workflow_activity_create(
+                'dataset_rejected', pkg_id, self.pkg_1, 'george',
+                feedback='Missing data dictionary')
+            assert_equals(helpers.get_latest_rejection_feedback(pkg_id),
+                          'Missing data dictionary')
+
+    def test_expire_latest_rejection_feedback(self):
+        pkg_id = self.package_approved['id']
+        assert_equals(helpers.get_latest_rejection_feedback(pkg_id), None)
+        key = helpers._get_latest_rejection_cache_key(pkg_id)
+        assert connect_to_redis().exists(key)
+
+        helpers.expire_latest_rejection_feedback()
+        assert not connect_to_redis().exists(key)
+
+    def test_backfill_workflow_transitions(self):
+        helpers.workflow_activity_create(
+            'dataset_rejected', self.package_approved['id'], self.pkg_1,
+            'george', feedback='Missing data dictionary')
+        model.Session.query(ed_model.WorkflowTransition).delete()
+        model.Session.commit()
+
+        assert_equals(ed_model.backfill_workflow_transitions(), 1)
+        # Already recorded activities are skipped
+        assert_equals(ed_model.backfill_workflow_transitions(), 0)
+        assert_equals(ed_model.WorkflowTransition.latest(
+            self.package_approved['id']).feedback, 'Missing data dictionary')
+
+    def test_package_activity_list_html_is_cached(self):
+        context = {'user': 'george'}
+        with self.app.flask_app.test_request_context():
+            html = call_action(
+                'package_activity_list_html', context, id=self.pkg_1)
+
+            with mock.patch(
+                    'ckanext.ed.actions.activity_list_to_html') as render:
+                assert_equals(call_action(
+                    'package_activity_list_html', context, id=self.pkg_1),
+                    html)
+                assert not render.called
+
+            # A new activity invalidates the cached stream
+            call_action('package_patch', context,
+                        id=self.pkg_1, title='Changed title')
+            assert 'Changed title' in call_action(
+                'package_activity_list_html', context, id=self.pkg_1)
+
+    def test_package_activity_list_html_cache_expires(self):
+        context = {'user': 'george'}
+        with self.app.flask_app.test_request_context():
+            call_action('package_activity_list_html', context, id=self.pkg_1)
+
+            # Relative times are rendered again in the next period
+            later = time.time() + actions.ACTIVITY_STREAM_CACHE_TTL
+            with mock.patch('ckanext.ed.actions.time') as time_, \
+                    mock.patch('ckanext.ed.actions.activity_list_to_html',
+                               return_value=u'') as render:
+                time_.time.return_value = later
+                call_action(
+                    'package_activity_list_html', context, id=self.pkg_1)
+                assert render.called
+
+    def test_package_activity_list_html_without_redis(self):
+        context = {'user': 'george'}
+        redis_conn = mock.Mock()
+        redis_conn.get.side_effect = RedisError('Connection refused')
+        with self.app.flask_app.test_request_context(), \
+                mock.patch('ckanext.ed.actions.connect_to_redis',
+                           return_value=redis_conn):
+            assert call_action(
+                'package_activity_list_html', context, id=self.pkg_1)
+            assert not redis_conn.set.called
+
+    def test_package_activity_list_cursor(self):
+        context = {'user': 'george'}
+        call_action('package_patch', context,
+                    id=self.pkg_1, title='Changed title')
+        activities = call_action(
+            'package_activity_list', context, id=self.pkg_1)
+
+        cursor = None
+        for expected in activities:
+            data_dict = {'id': self.pkg_1, 'limit': 1}
+            if cursor:
+                data_dict['cursor'] = cursor
+            page = call_action('package_activity_list', context, **data_dict)
+            assert_equals([a['id'] for a in page], [expected['id']])
+            cursor = '{0},{1}'.format(page[0]['timestamp'], page[0]['id'])
+
 
 # Helpers
 
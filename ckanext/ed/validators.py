@@ -7,6 +7,8 @@ from ckan.model import (PACKAGE_NAME_MIN_LENGTH, PACKAGE_NAME_MAX_LENGTH)
 from ckan.model.core import State
 from ckan.common import _
 
+from ckanext.ed import helpers
+
 missing = df.missing
 
 log = logging.getLogger(__name__)
@@ -20,8 +22,7 @@ def state_validator(key, data, errors, context):
 
     Note: Not used anymore
     '''
-    user_orgs = toolkit.get_action('organization_list_for_user')(
-        context, {'id': context['user']})
+    capacities = helpers.get_user_capacities(context['user'])
     office_id = data.get(('owner_org',))
     state = data.pop(key, None)
 
@@ -33,14 +34,13 @@ def state_validator(key, data, errors, context):
         state = context.get('package').extras.get('approval_state')
 
     # If the user is member of the organization but not admin, keep state as is
-    for org in user_orgs:
-        if org.get('id') == office_id:
-            if org.get('capacity') == 'admin':
-                # If no state provided and user is an admin, default to active
-                state = state or 'active'
-            else:
-                # If not admin, create as pending or keep state as was
-                state = state or 'approval_pending'
+    if office_id in capacities:
+        if capacities[office_id] == 'admin':
+            # If no state provided and user is an admin, default to active
+            state = state or 'active'
+        else:
+            # If not admin, create as pending or keep state as was
+            state = state or 'approval_pending'
     data[key] = state
 
 